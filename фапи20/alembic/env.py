@@ -1,5 +1,6 @@
 from logging.config import fileConfig
 from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
 from alembic import context
 import asyncio
 from sqlmodel import SQLModel
@@ -11,7 +12,8 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
-if config.config_file_name is not None:
+# При запуске из приложения (startup.py) логирование уже настроено в logger.py.
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
     fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
@@ -50,17 +52,25 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 def do_run_migrations(connection):
-    context.configure(connection=connection, target_metadata=target_metadata)
+    # Каждая ревизия выполняется в своей транзакции, чтобы миграции могли выходить
+    # из транзакции (CREATE INDEX CONCURRENTLY, пакетные обновления) через autocommit_block().
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        transaction_per_migration=True,
+    )
 
     with context.begin_transaction():
         context.run_migrations()
 
 async def run_async_migrations() -> None:
-    connectable = create_async_engine(config.get_main_option("sqlalchemy.url"), echo=True, future=True)
+    connectable = create_async_engine(config.get_main_option("sqlalchemy.url"), poolclass=NullPool, future=True)
 
-    async with connectable.begin() as connection:
+    async with connectable.connect() as connection:
         await connection.run_sync(do_run_migrations)
 
+    await connectable.dispose()
+
 def run_migrations_online() -> None:
     asyncio.run(run_async_migrations())
 
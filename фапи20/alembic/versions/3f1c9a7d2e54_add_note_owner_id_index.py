@@ -0,0 +1,29 @@
+"""Add index on note.owner_id
+
+Revision ID: 3f1c9a7d2e54
+Revises: e493375076d0
+Create Date: 2026-10-19 10:12:41.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from migration_helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9a7d2e54'
+down_revision: Union[str, None] = 'e493375076d0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    create_index_concurrently(op.f('ix_note_owner_id'), 'note', ['owner_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    drop_index_concurrently(op.f('ix_note_owner_id'), 'note')
@@ -5,8 +5,10 @@ from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from sqlmodel.ext.asyncio.session import AsyncSession
 from models import User
-from database import async_session
+from queries import USER_BY_USERNAME
+from database import get_session, request_principal
 from config import settings
+from server_timing import request_timings, timed
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
@@ -25,30 +27,33 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 async def get_user_by_username(session: AsyncSession, username: str):
-    from sqlmodel import select
-    statement = select(User).where(User.username == username)
-    result = await session.execute(statement)
+    result = await session.execute(USER_BY_USERNAME, {"username": username})
     return result.scalar_one_or_none()
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_session)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        with timed("jwt"):
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
-    async with async_session() as session:
+    request_principal.set(username)
+    with timed("auth_db"):
         user = await get_user_by_username(session, username)
-        if user is None:
-            raise credentials_exception
-        return user
+    if user is None:
+        raise credentials_exception
+    timings = request_timings.get()
+    if timings is not None and user.role == "admin":
+        timings.expose = True
+    return user
 
 def require_role(required_role: str):
     async def role_checker(current_user: User = Depends(get_current_user)):
@@ -0,0 +1,127 @@
+"""
+Накладные расходы middleware: чистый ASGI против BaseHTTPMiddleware.
+
+Приложение с маршрутом hello-world и потоковым маршрутом оборачивается LoggingMiddleware и
+RateLimiterMiddleware из middleware.py и их прежними версиями на BaseHTTPMiddleware. Запросы подаются
+прямо в ASGI-приложение, без сети, поэтому видны только расходы самих middleware. Для потокового
+маршрута дополнительно меряется время до первого куска тела.
+
+Лимитер пропускает всё и не ходит в Redis: здесь интересна обвязка, а не лимитер.
+
+    python benchmarks/bench_middleware.py
+"""
+import asyncio
+import time
+from common import report, percentile
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from logger import logger
+from middleware import LoggingMiddleware, RateLimiterMiddleware
+from rate_limiter import RateLimitResult
+
+HELLO_REQUESTS = 3000
+STREAM_REQUESTS = 300
+STREAM_CHUNKS = 100
+
+class AllowAll:
+    async def hit(self, identity, rule=None):
+        return RateLimitResult(allowed=True, limit=100, remaining=99, retry_after=0, reset=0)
+
+class BaseHTTPLoggingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        start_time = time.perf_counter()
+        response = await call_next(request)
+        logger.info(f"{request.method} {request.url.path} completed in {time.perf_counter() - start_time:.2f}s")
+        return response
+
+class BaseHTTPRateLimiterMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, limiter):
+        super().__init__(app)
+        self.limiter = limiter
+
+    async def dispatch(self, request: Request, call_next):
+        result = await self.limiter.hit(request.client.host)
+        if not result.allowed:
+            return JSONResponse(status_code=429, content={}, headers=result.headers())
+        response = await call_next(request)
+        response.headers.update(result.headers())
+        return response
+
+def build_app(logging_middleware, limiter_middleware) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/hello")
+    async def hello():
+        return {"message": "hello"}
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for _ in range(STREAM_CHUNKS):
+                yield b"x" * 1024
+                await asyncio.sleep(0)
+        return StreamingResponse(chunks())
+
+    app.add_middleware(logging_middleware)
+    app.add_middleware(limiter_middleware, limiter=AllowAll())
+    return app
+
+async def call(app, path: str) -> tuple[float, float]:
+    """Один запрос напрямую в ASGI-приложение: (время до первого куска тела, полное время)."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": b"", "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    finished = asyncio.Event()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    start = time.perf_counter()
+    first_byte = None
+
+    async def send(message):
+        nonlocal first_byte
+        if message["type"] == "http.response.body":
+            if first_byte is None and message.get("body"):
+                first_byte = time.perf_counter() - start
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    return first_byte or 0.0, time.perf_counter() - start
+
+async def run(title: str, app, path: str, requests: int):
+    first_bytes, latencies = [], []
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        first_byte, latency = await call(app, path)
+        first_bytes.append(first_byte)
+        latencies.append(latency)
+    report(title, latencies, time.process_time() - cpu_start, time.perf_counter() - wall_start)
+    if path == "/stream":
+        print(f"{'':<40} ttfb p50={percentile(first_bytes, 0.5) * 1000:.2f}ms p99={percentile(first_bytes, 0.99) * 1000:.2f}ms")
+
+async def main():
+    logger.disabled = True
+    variants = {
+        "BaseHTTPMiddleware": build_app(BaseHTTPLoggingMiddleware, BaseHTTPRateLimiterMiddleware),
+        "pure ASGI": build_app(LoggingMiddleware, RateLimiterMiddleware),
+    }
+    for path, requests in (("/hello", HELLO_REQUESTS), ("/stream", STREAM_REQUESTS)):
+        for name, app in variants.items():
+            await call(app, path)
+            await run(f"{name} GET {path}", app, path, requests)
+
+if __name__ == "__main__":
+    asyncio.run(main())
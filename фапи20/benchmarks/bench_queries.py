@@ -0,0 +1,60 @@
+"""
+Бенчмарк реестра горячих запросов (queries.py) и кеша подготовленных выражений asyncpg.
+
+1. Построение запроса: ad-hoc select() на каждый запрос против готового выражения из реестра.
+2. GET /notes/ end-to-end (нужны PostgreSQL и Redis): процесс запускается с кешем
+   подготовленных выражений и без него, сравнивается CPU-время на запрос.
+
+    python benchmarks/bench_queries.py [--requests 2000]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import common
+
+def bench_statement_building(iterations: int):
+    from sqlmodel import select
+    from models import Note
+    from queries import NOTES_PAGE_BY_OWNER
+
+    start = time.process_time()
+    for _ in range(iterations):
+        statement = select(Note).where(Note.owner_id == 1).offset(0).limit(100)
+        statement._generate_cache_key()
+    ad_hoc = time.process_time() - start
+
+    start = time.process_time()
+    for _ in range(iterations):
+        NOTES_PAGE_BY_OWNER._generate_cache_key()
+    registry = time.process_time() - start
+
+    print(f"{'statement build, ad-hoc select()':<40} {ad_hoc / iterations * 1e6:>8.1f}us")
+    print(f"{'statement build, registry':<40} {registry / iterations * 1e6:>8.1f}us")
+
+async def bench_endpoint(requests: int, title: str):
+    async with common.app_client() as client:
+        await common.measure(client, "GET", "/notes/", 50)
+        common.report(title, *await common.measure(client, "GET", "/notes/", requests))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--endpoint-only", metavar="TITLE")
+    args = parser.parse_args()
+
+    if args.endpoint_only:
+        asyncio.run(bench_endpoint(args.requests, args.endpoint_only))
+        return
+
+    bench_statement_building(20000)
+    for title, cache_size in (("GET /notes/ prepared cache off", "0"), ("GET /notes/ prepared cache on", "500")):
+        env = {**os.environ, "DB_PREPARED_STATEMENT_CACHE_SIZE": cache_size, "DB_ECHO": "false"}
+        subprocess.run([sys.executable, __file__, "--requests", str(args.requests), "--endpoint-only", title],
+                       env=env, check=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Время до первого успешного запроса при запуске uvicorn с несколькими воркерами.
+
+Запускает `uvicorn main:app --workers N` и опрашивает /health, пока все воркеры не
+ответят (или пока не истечёт таймаут). Нужны PostgreSQL и Redis.
+
+    python benchmarks/bench_startup.py --workers 16
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def wait_for_health(url: str, timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f"{url} did not become healthy in {timeout}s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--workers", str(args.workers), "--port", str(args.port)],
+        cwd=PROJECT_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        first = wait_for_health(f"http://127.0.0.1:{args.port}/health", args.timeout)
+        print(f"workers={args.workers} time_to_first_request={first:.2f}s (spawn to first 200: {time.perf_counter() - start:.2f}s)")
+        print(f"per-worker startup time: see app_startup_seconds at http://127.0.0.1:{args.port}/metrics")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
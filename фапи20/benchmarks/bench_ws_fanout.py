@@ -0,0 +1,109 @@
+"""
+Задержка доставки WebSocket-рассылки между процессами через Redis pub/sub.
+
+Запускает N процессов-подписчиков, у каждого свой ConnectionManager и RedisBroadcast, как у воркера uvicorn.
+Клиентов всего M, они поровну делятся между процессами. Процесс-публикатор отправляет сообщения с отметкой
+времени через тот же RedisBroadcast. Задержка считается от publish до передачи сообщения в сокет клиента,
+поэтому в неё входят пакетирование, путь через Redis, раздача по очередям и задачи отправки.
+Клиенты — заглушки в памяти: сетевой стек WebSocket не меряется. Нужен Redis (REDIS_URL).
+
+    python benchmarks/bench_ws_fanout.py --processes 4 --clients 2000 --messages 100 --interval-ms 100
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+from common import percentile
+from redis.asyncio import Redis
+from broadcast import RedisBroadcast
+from config import settings
+from logger import logger
+from websocket_manager import ConnectionManager
+
+CHANNEL = "bench:ws"
+
+class TimingWebSocket:
+    """Клиент-заглушка: записывает задержку каждого сообщения (сообщение — время отправки)."""
+
+    def __init__(self, latencies: list[float]):
+        self.latencies = latencies
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        self.latencies.append(time.time() - float(message))
+
+    async def close(self, code: int):
+        pass
+
+async def subscriber(clients: int, expected: int, results, batch_ms: float):
+    logger.disabled = True
+    redis = Redis.from_url(settings.REDIS_URL)
+    manager = ConnectionManager(queue_size=expected, overflow_policy="drop_newest", send_timeout=60)
+    node = RedisBroadcast(manager, redis, CHANNEL, batch_window=batch_ms / 1000, max_batch=100)
+    latencies: list[float] = []
+    for _ in range(clients):
+        await manager.connect(TimingWebSocket(latencies))
+    node.start()
+
+    deadline = time.monotonic() + 60
+    while len(latencies) < clients * expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    results.put(latencies)
+    await node.close()
+    await redis.aclose()
+
+def run_subscriber(*args):
+    asyncio.run(subscriber(*args))
+
+async def publish(processes: int, messages: int, interval: float, batch_ms: float):
+    redis = Redis.from_url(settings.REDIS_URL)
+    while (await redis.execute_command("PUBSUB", "NUMSUB", CHANNEL))[1] < processes:
+        await asyncio.sleep(0.05)
+    node = RedisBroadcast(ConnectionManager(), redis, CHANNEL, batch_window=batch_ms / 1000, max_batch=100)
+    for _ in range(messages):
+        node.publish(repr(time.time()))
+        await asyncio.sleep(interval)
+    await node.close()
+    await redis.aclose()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=2000, help="всего клиентов на все процессы")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--interval-ms", type=float, default=100.0, help="пауза между сообщениями публикатора")
+    parser.add_argument("--batch-ms", type=float, default=settings.WS_BROADCAST_BATCH_MS)
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    per_process = args.clients // args.processes
+    workers = [
+        multiprocessing.Process(
+            target=run_subscriber, args=(per_process, args.messages, results, args.batch_ms)
+        )
+        for _ in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    start = time.perf_counter()
+    asyncio.run(publish(args.processes, args.messages, args.interval_ms / 1000, args.batch_ms))
+    latencies = [latency for _ in workers for latency in results.get()]
+    wall = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+
+    expected = per_process * args.processes * args.messages
+    print(
+        f"processes={args.processes} clients={per_process * args.processes} messages={args.messages} "
+        f"batch={args.batch_ms}ms delivered={len(latencies)}/{expected} ({len(latencies) / wall:.0f}/s)"
+    )
+    print(
+        f"latency p50={percentile(latencies, 0.5) * 1000:.2f}ms p99={percentile(latencies, 0.99) * 1000:.2f}ms "
+        f"max={max(latencies) * 1000:.2f}ms"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Общие утилиты для бенчмарков.
+
+Бенчмарки запускаются из корня проекта (`python benchmarks/<имя>.py`) и используют
+те же переменные окружения, что и приложение (DATABASE_URL, REDIS_URL, ...).
+"""
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def report(title: str, latencies: list[float], cpu_seconds: float, wall_seconds: float):
+    count = len(latencies)
+    print(
+        f"{title:<40} n={count:<6} rps={count / wall_seconds:>9.1f} "
+        f"p50={percentile(latencies, 0.5) * 1000:>7.2f}ms p99={percentile(latencies, 0.99) * 1000:>7.2f}ms "
+        f"cpu/req={cpu_seconds / count * 1e6:>8.1f}us"
+    )
+
+@asynccontextmanager
+async def app_client():
+    """Клиент к приложению в том же процессе, с выполненным lifespan и тестовым пользователем."""
+    from httpx import AsyncClient, ASGITransport
+    from asgi_lifespan import LifespanManager
+    from main import app
+    from database import async_session
+    from auth import get_user_by_username, get_password_hash, create_access_token
+    from models import User, Note
+
+    async with LifespanManager(app):
+        async with async_session() as session:
+            user = await get_user_by_username(session, "bench")
+            if user is None:
+                user = User(username="bench", hashed_password=get_password_hash("benchpass"))
+                session.add(user)
+                await session.commit()
+                await session.refresh(user)
+                session.add_all([Note(text=f"bench note {i}", owner_id=user.id) for i in range(100)])
+                await session.commit()
+        token = create_access_token({"sub": "bench"})
+        transport = ASGITransport(app=app)
+        async with AsyncClient(base_url="http://bench", transport=transport,
+                               headers={"Authorization": f"Bearer {token}"}) as client:
+            yield client
+
+async def measure(client, method: str, url: str, requests: int, **kwargs):
+    latencies = []
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latencies, time.process_time() - cpu_start, time.perf_counter() - wall_start
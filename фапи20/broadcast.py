@@ -0,0 +1,137 @@
+import asyncio
+import contextvars
+import json
+from typing import Optional, Union
+from uuid import uuid4
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from config import settings
+from logger import logger
+from metrics import WEBSOCKET_BROADCAST_BATCH_SIZE
+from redis_sharding import ShardedRedis
+from websocket_manager import ConnectionManager
+
+class LocalBroadcast:
+    """Рассылка в пределах процесса: клиентам других воркеров сообщения не доходят."""
+
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+
+    def publish(self, message: str):
+        self.manager.broadcast(message)
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+class RedisBroadcast:
+    """
+    Рассылка между воркерами и узлами через Redis pub/sub.
+
+    Каждый процесс держит одну подписку на channel и раздаёт полученное своим клиентам. Сообщения
+    собственных клиентов раздаются локально сразу, а в Redis уходят пачкой: всё, что накопилось за
+    batch_window секунд (или max_batch сообщений), публикуется одним PUBLISH. Свои пачки подписчик
+    узнаёт по origin и пропускает. Пока Redis недоступен, рассылка работает в пределах процесса.
+    """
+
+    def __init__(
+        self,
+        manager: ConnectionManager,
+        redis: Union[aioredis.Redis, ShardedRedis],
+        channel: str,
+        batch_window: float,
+        max_batch: int,
+        retry_interval: float = 1.0,
+    ):
+        self.manager = manager
+        # Обычный Redis не передаёт сообщения между шардами: канал живёт на шарде, которому принадлежит его имя
+        self.redis = redis.shard(channel) if isinstance(redis, ShardedRedis) else redis
+        self.channel = channel
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.retry_interval = retry_interval
+        self.origin = uuid4().hex
+        self._pending: list[str] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set[asyncio.Task] = set()
+        self._subscriber: Optional[asyncio.Task] = None
+
+    def publish(self, message: str):
+        self.manager.broadcast(message)
+        self._pending.append(message)
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.batch_window, self._start_flush)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._flush(batch), context=contextvars.Context())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: list[str]):
+        WEBSOCKET_BROADCAST_BATCH_SIZE.observe(len(batch))
+        try:
+            await self.redis.publish(self.channel, json.dumps({"origin": self.origin, "messages": batch}))
+        except RedisError as e:
+            logger.warning(f"WebSocket broadcast of {len(batch)} messages not published: {e!r}")
+
+    def _deliver(self, data: bytes):
+        payload = json.loads(data)
+        if payload["origin"] == self.origin:
+            return
+        for message in payload["messages"]:
+            self.manager.broadcast(message)
+
+    async def _subscribe(self):
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    try:
+                        self._deliver(message["data"])
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.error(f"Malformed WebSocket broadcast message: {e!r}")
+            except asyncio.CancelledError:
+                raise
+            except (RedisError, OSError) as e:
+                logger.warning(f"WebSocket broadcast subscription lost: {e!r}")
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(self.retry_interval)
+
+    def start(self):
+        if self._subscriber is None:
+            self._subscriber = asyncio.create_task(self._subscribe())
+
+    async def close(self):
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            await asyncio.gather(self._subscriber, return_exceptions=True)
+            self._subscriber = None
+
+def create_broadcast(manager: ConnectionManager, redis: Union[aioredis.Redis, ShardedRedis]):
+    if settings.WS_BROADCAST_BACKEND == "redis":
+        return RedisBroadcast(
+            manager,
+            redis,
+            channel=settings.WS_BROADCAST_CHANNEL,
+            batch_window=settings.WS_BROADCAST_BATCH_MS / 1000,
+            max_batch=settings.WS_BROADCAST_MAX_BATCH,
+        )
+    return LocalBroadcast(manager)
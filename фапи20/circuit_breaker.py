@@ -0,0 +1,122 @@
+import asyncio
+import time
+from collections import deque
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from logger import logger
+from metrics import CIRCUIT_BREAKER_STATE, CIRCUIT_BREAKER_REJECTED
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(RedisConnectionError):
+    """Вызов отклонён без обращения к Redis: breaker разомкнут."""
+
+class CircuitBreaker:
+    """
+    Размыкается, если за последние window секунд набралось не меньше min_calls вызовов и доля
+    неудачных достигла failure_rate. Неудачными считаются ошибки соединения, таймауты
+    и вызовы дольше slow_call_seconds, в том числе отменённые вызывающим позже этого порога;
+    отменённые раньше не учитываются. Поэтому slow_call_seconds должен быть меньше таймаутов вызывающих.
+
+    Через open_seconds breaker пропускает до half_open_probes пробных вызовов: если все успешны,
+    он замыкается, при первой неудаче размыкается снова.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float,
+        slow_call_seconds: float,
+        min_calls: int,
+        window: float,
+        open_seconds: float,
+        half_open_probes: int,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.calls: deque[tuple[float, bool]] = deque()
+        # Число неудачных в calls: ведётся при добавлении и вытеснении, чтобы не пересчитывать окно на каждый вызов
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+        self._set_state(CLOSED)
+
+    def _set_state(self, state: str):
+        self.state = state
+        CIRCUIT_BREAKER_STATE.labels(name=self.name).set(STATE_VALUES[state])
+
+    def _open(self):
+        logger.warning(f"Circuit breaker {self.name} opened")
+        self.opened_at = time.monotonic()
+        self.calls.clear()
+        self.failures = 0
+        self._set_state(OPEN)
+
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.probes_in_flight = self.probes_succeeded = 0
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self.probes_in_flight + self.probes_succeeded >= self.half_open_probes:
+                return False
+            self.probes_in_flight += 1
+            return True
+        return self.state == CLOSED
+
+    def record(self, failed: bool, probe: bool):
+        if probe:
+            self.probes_in_flight -= 1
+            if self.state != HALF_OPEN:
+                return
+            if failed:
+                self._open()
+                return
+            self.probes_succeeded += 1
+            if self.probes_succeeded >= self.half_open_probes:
+                logger.info(f"Circuit breaker {self.name} closed")
+                self._set_state(CLOSED)
+            return
+
+        now = time.monotonic()
+        self.calls.append((now, failed))
+        self.failures += failed
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.failures -= self.calls.popleft()[1]
+        if self.state == CLOSED and len(self.calls) >= self.min_calls:
+            if self.failures / len(self.calls) >= self.failure_rate:
+                self._open()
+
+    async def call(self, func, *args, **kwargs):
+        if not self.allow():
+            CIRCUIT_BREAKER_REJECTED.labels(name=self.name).inc()
+            raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+
+        probe = self.state == HALF_OPEN
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await func(*args, **kwargs)
+            failed = time.perf_counter() - start >= self.slow_call_seconds
+            return result
+        except asyncio.CancelledError:
+            # Отмена по таймауту вызывающего говорит о Redis, только если вызов уже успел стать медленным
+            if time.perf_counter() - start < self.slow_call_seconds:
+                failed = None
+            raise
+        except (RedisConnectionError, RedisTimeoutError, asyncio.TimeoutError, OSError):
+            raise
+        except Exception:
+            # Ошибки уровня команды (например, NOSCRIPT) означают, что Redis отвечает
+            failed = False
+            raise
+        finally:
+            if failed is not None:
+                self.record(failed, probe)
+            elif probe:
+                self.probes_in_flight -= 1
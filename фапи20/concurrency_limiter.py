@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import deque
+from metrics import CONCURRENCY_LIMIT, CONCURRENCY_IN_FLIGHT, CONCURRENCY_SHED
+
+CRITICAL, HIGH, NORMAL, LOW = "critical", "high", "normal", "low"
+
+# Какую долю текущего лимита может занять класс: чем ниже приоритет, тем раньше его начинают отсекать.
+# CRITICAL не ограничивается вовсе.
+PRIORITY_SHARES = {HIGH: 1.0, NORMAL: 0.9, LOW: 0.5}
+WAKE_ORDER = (HIGH, NORMAL)
+
+# Ключ — "МЕТОД шаблон_маршрута"; остальные запросы: записи с токеном — HIGH, прочее — NORMAL
+ROUTE_PRIORITIES: dict[str, str] = {
+    "GET /health": CRITICAL,
+    "GET /metrics": CRITICAL,
+    "POST /trigger-task": LOW,
+}
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+def request_priority(method: str, route: str, authenticated: bool) -> str:
+    priority = ROUTE_PRIORITIES.get(f"{method} {route}")
+    if priority is not None:
+        return priority
+    if authenticated and method in WRITE_METHODS:
+        return HIGH
+    return NORMAL
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Ограничение числа одновременно обрабатываемых запросов по AIMD.
+
+    Пока запросы укладываются в target_latency и лимит используется полностью, он растёт на 1 за каждые
+    limit запросов. Когда обработка дольше target_latency или завершилась ошибкой, лимит умножается на
+    backoff, но не чаще раза в target_latency, чтобы одна волна медленных ответов не обрушила его до минимума.
+
+    Запросы сверх лимита ждут в ограниченной очереди не дольше max_queue_time; LOW не ждёт вовсе.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        target_latency: float,
+        backoff: float,
+        queue_size: int,
+        max_queue_time: float,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self.max_queue_time = max_queue_time
+        self.in_flight = 0
+        self.waiters: dict[str, deque[asyncio.Future]] = {priority: deque() for priority in WAKE_ORDER}
+        self.last_decrease = 0.0
+        CONCURRENCY_LIMIT.set(self.limit)
+
+    def _capacity(self, priority: str) -> int:
+        return max(1, int(self.limit * PRIORITY_SHARES[priority]))
+
+    def _shed(self, priority: str, reason: str) -> bool:
+        CONCURRENCY_SHED.labels(priority=priority, reason=reason).inc()
+        return False
+
+    def _admit(self):
+        self.in_flight += 1
+        CONCURRENCY_IN_FLIGHT.set(self.in_flight)
+
+    async def acquire(self, priority: str) -> bool:
+        if priority == CRITICAL:
+            self._admit()
+            return True
+
+        # Обгонять в очереди можно только запросы с более низким приоритетом
+        ahead = WAKE_ORDER if priority == LOW else WAKE_ORDER[:WAKE_ORDER.index(priority) + 1]
+        if self.in_flight < self._capacity(priority) and not any(self.waiters[p] for p in ahead):
+            self._admit()
+            return True
+        if priority == LOW:
+            return self._shed(priority, "low_priority")
+        if sum(len(waiters) for waiters in self.waiters.values()) >= self.queue_size:
+            return self._shed(priority, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_queue_time)
+            return True
+        except asyncio.TimeoutError:
+            return self._shed(priority, "queue_timeout")
+        except asyncio.CancelledError:
+            # Слот уже был передан, но запрос отменили раньше, чем он его занял
+            if waiter.done() and not waiter.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            raise
+        finally:
+            if waiter in self.waiters[priority]:
+                self.waiters[priority].remove(waiter)
+
+    def release(self, latency: float, failed: bool):
+        self.in_flight -= 1
+        now = time.monotonic()
+        if failed or latency > self.target_latency:
+            if now - self.last_decrease >= self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+        elif self.in_flight + 1 >= int(self.limit):
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        CONCURRENCY_LIMIT.set(self.limit)
+        self._wake()
+        CONCURRENCY_IN_FLIGHT.set(self.in_flight)
+
+    def _wake(self):
+        # Освободившийся слот сразу передаётся ожидающему с наивысшим приоритетом
+        for priority in WAKE_ORDER:
+            waiters = self.waiters[priority]
+            while waiters and self.in_flight < self._capacity(priority):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    self.in_flight += 1
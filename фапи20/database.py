@@ -1,15 +1,274 @@
+import asyncio
+import itertools
 import os
-from sqlmodel import SQLModel
+import time
+from uuid import uuid4
+from contextvars import ContextVar
+from typing import AsyncGenerator, Optional
+from fastapi import Request
+from sqlmodel import Session
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import event, exc, text, Insert, Update, Delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config import settings
+from logger import logger
+from metrics import (
+    DB_POOL_SIZE, DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT_SECONDS, DB_POOL_TIMEOUTS,
+    DB_REPLICA_HEALTHY,
+)
+from deadlines import remaining_time
+from sql_tracing import RequestDbStats, request_db_stats, instrument_engine, observe_request
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True, future=True)
+# Имя пользователя, от имени которого выполняется текущий запрос (для read-your-writes)
+request_principal: ContextVar[Optional[str]] = ContextVar("request_principal", default=None)
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, который замеряет время ожидания свободного соединения."""
+
+    def _do_get(self):
+        name = self.logging_name or "primary"
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.labels(pool=name).inc()
+            raise
+        finally:
+            DB_POOL_WAIT_SECONDS.labels(pool=name).observe(time.perf_counter() - start)
+
+def instrument_pool(engine: AsyncEngine, name: str):
+    sync_engine = engine.sync_engine
+    DB_POOL_SIZE.labels(pool=name).set(sync_engine.pool.size())
+
+    def update_gauges(*args):
+        pool = sync_engine.pool
+        DB_POOL_CHECKED_OUT.labels(pool=name).set(pool.checkedout())
+        DB_POOL_OVERFLOW.labels(pool=name).set(max(pool.overflow(), 0))
+
+    def on_checkout(*args):
+        update_gauges()
+        stats = request_db_stats.get()
+        if stats is not None:
+            stats.checkouts += 1
+
+    event.listen(sync_engine, "checkout", on_checkout)
+    event.listen(sync_engine, "checkin", update_gauges)
+
+def asyncpg_connect_args() -> dict:
+    if settings.DB_PGBOUNCER_TRANSACTION_MODE:
+        # PgBouncer в режиме transaction может отдать следующий запрос другому серверному
+        # соединению, поэтому кеш подготовленных выражений отключается, а имена делаются уникальными
+        return {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        }
+    return {"prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE}
+
+def is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+def configure_sqlite(engine: AsyncEngine, writer: bool):
+    """
+    Настройки SQLite для встроенного режима: WAL позволяет читать во время записи,
+    а пишущее соединение открывает транзакцию через BEGIN IMMEDIATE и сразу берёт
+    блокировку записи, вместо того чтобы получить "database is locked" при первом UPDATE.
+    """
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # Транзакциями управляет SQLAlchemy (событие begin ниже), а не драйвер
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def on_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE" if writer else "BEGIN")
+
+def create_engine_from_settings(url: str, name: str, writer: bool = False) -> AsyncEngine:
+    sqlite = is_sqlite(url)
+    connect_args = asyncpg_connect_args() if make_url(url).get_driver_name() == "asyncpg" else {}
+    new_engine = create_async_engine(
+        url,
+        echo=settings.DB_ECHO,
+        future=True,
+        connect_args=connect_args,
+        poolclass=InstrumentedPool,
+        # В SQLite пишет одно соединение; пул из одного соединения служит очередью писателей
+        pool_size=1 if sqlite and writer else settings.DB_POOL_SIZE,
+        max_overflow=0 if sqlite and writer else settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        pool_logging_name=name,
+    )
+    if sqlite:
+        configure_sqlite(new_engine, writer)
+    instrument_pool(new_engine, name)
+    instrument_engine(new_engine)
+    return new_engine
+
+SQLITE_MODE = is_sqlite(settings.DATABASE_URL)
+
+engine = create_engine_from_settings(settings.DATABASE_URL, "primary", writer=True)
+
+class ReplicaSet:
+    """
+    Набор реплик для чтения.
+
+    Реплики выбираются по кругу; недоступные исключаются из ротации до следующей
+    успешной проверки. Пользователь, недавно писавший в БД, читает с primary
+    в течение DB_READ_YOUR_WRITES_WINDOW секунд. Окно хранится в памяти процесса,
+    поэтому с несколькими воркерами оно действует только в пределах воркера,
+    обработавшего запись.
+    """
+
+    def __init__(self, urls: list[str], read_your_writes: bool = True):
+        self.names = [f"replica-{i}" for i in range(len(urls))]
+        self.engines = [create_engine_from_settings(url, name) for url, name in zip(urls, self.names)]
+        self.healthy = [True] * len(self.engines)
+        self._counter = itertools.count()
+        self.read_your_writes = read_your_writes
+        self._recent_writes: dict[str, float] = {}
+        self._health_task: Optional[asyncio.Task] = None
+        for index, replica_engine in enumerate(self.engines):
+            DB_REPLICA_HEALTHY.labels(pool=self.names[index]).set(1)
+            event.listen(replica_engine.sync_engine, "handle_error", self._make_error_handler(index))
+
+    def _make_error_handler(self, index: int):
+        def on_error(context):
+            if context.is_disconnect:
+                self._set_health(index, False)
+        return on_error
+
+    def _set_health(self, index: int, healthy: bool):
+        if self.healthy[index] != healthy:
+            logger.warning(f"Replica {self.names[index]} is {'healthy' if healthy else 'unavailable'}")
+        self.healthy[index] = healthy
+        DB_REPLICA_HEALTHY.labels(pool=self.names[index]).set(1 if healthy else 0)
+
+    def mark_write(self, principal: str):
+        if self.engines and self.read_your_writes:
+            self._recent_writes[principal] = time.monotonic() + settings.DB_READ_YOUR_WRITES_WINDOW
+
+    def _wrote_recently(self, principal: Optional[str]) -> bool:
+        if principal is None:
+            return False
+        deadline = self._recent_writes.get(principal)
+        if deadline is None:
+            return False
+        if deadline < time.monotonic():
+            self._recent_writes.pop(principal, None)
+            return False
+        return True
+
+    def pick(self, principal: Optional[str] = None) -> AsyncEngine:
+        if not self.engines or self._wrote_recently(principal):
+            return engine
+        for _ in range(len(self.engines)):
+            index = next(self._counter) % len(self.engines)
+            if self.healthy[index]:
+                return self.engines[index]
+        return engine
+
+    async def check_health(self):
+        for index, replica_engine in enumerate(self.engines):
+            try:
+                async with replica_engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+                self._set_health(index, True)
+            except Exception as e:
+                logger.error(f"Replica {self.names[index]} health check failed: {str(e)}")
+                self._set_health(index, False)
+        now = time.monotonic()
+        for principal, deadline in list(self._recent_writes.items()):
+            if deadline < now:
+                self._recent_writes.pop(principal, None)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(settings.DB_REPLICA_HEALTH_CHECK_INTERVAL)
+            await self.check_health()
+
+    def start(self):
+        if self.engines and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for replica_engine in self.engines:
+            await replica_engine.dispose()
+
+if SQLITE_MODE:
+    # Встроенный режим: читающие соединения к тому же файлу работают как реплика,
+    # в WAL они видят все зафиксированные записи, поэтому окно read-your-writes не нужно
+    replicas = ReplicaSet([settings.DATABASE_URL], read_your_writes=False)
+else:
+    replicas = ReplicaSet(settings.DATABASE_REPLICA_URLS)
+
+class RoutingSession(Session):
+    """
+    Сессия, которая читает с реплики, а изменения отправляет на primary.
+
+    Сессии с info["use_primary"] (запросы, изменяющие данные) целиком работают с primary,
+    чтобы проверка пользователя и запись шли через одно соединение.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get("use_primary") or self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            return engine.sync_engine
+        bind = self.info.get("read_bind")
+        if bind is None:
+            bind = self.info["read_bind"] = replicas.pick(request_principal.get())
+        return bind.sync_engine
+
+@event.listens_for(RoutingSession, "after_begin")
+def apply_statement_timeout(session, transaction, connection):
+    # Запрос к БД не должен пережить бюджет HTTP-запроса
+    remaining = remaining_time()
+    if remaining is not None and connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(remaining * 1000), 1)}")
+
+@event.listens_for(Session, "after_flush")
+def remember_write(session, flush_context):
+    principal = request_principal.get()
+    if principal is not None:
+        replicas.mark_write(principal)
 
 def get_async_session_factory():
     return sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
-async def create_db_and_tables():
-    async with engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
+def get_request_session_factory():
+    return sessionmaker(engine, expire_on_commit=False, class_=AsyncSession, sync_session_class=RoutingSession)
+
+async_session = get_async_session_factory()
+request_session = get_request_session_factory()
+
+READ_ONLY_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+async def get_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Единая сессия БД на HTTP-запрос.
+
+    FastAPI кеширует зависимость в пределах запроса, поэтому get_current_user и обработчик
+    получают одну и ту же сессию и одно соединение из пула.
+    """
+    route = request.scope.get("route")
+    stats = RequestDbStats(route=getattr(route, "path", "unmatched"))
+    request_db_stats.set(stats)
+    use_primary = request.method not in READ_ONLY_METHODS
+    try:
+        async with request_session(info={"use_primary": use_primary}) as session:
+            yield session
+    finally:
+        observe_request(stats)
\ No newline at end of file
@@ -0,0 +1,37 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+from starlette.routing import Match
+from starlette.types import Scope
+
+# Момент (time.monotonic()), после которого результат текущего запроса уже не нужен клиенту
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+def remaining_time() -> Optional[float]:
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+def bounded_timeout(timeout: float) -> float:
+    """Таймаут отдельной операции, не превышающий остаток бюджета запроса."""
+    remaining = remaining_time()
+    return timeout if remaining is None else min(timeout, remaining)
+
+def resolve_route_path(scope: Scope) -> str:
+    """
+    Шаблон маршрута (например, /notes/{note_id}) до того, как запрос дошёл до роутера.
+
+    Для запросов, не совпавших ни с одним маршрутом, — "unmatched": результат идёт в метки метрик,
+    и сырой путь позволил бы клиенту плодить серии.
+    """
+    # Результат запоминается в scope: маршрут нужен сразу нескольким middleware
+    if "route_path" in scope:
+        return scope["route_path"]
+    scope["route_path"] = "unmatched"
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            scope["route_path"] = route.path
+            break
+    return scope["route_path"]
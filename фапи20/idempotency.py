@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import time
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from deadlines import bounded_timeout
+from logger import logger
+from redis_sharding import tagged
+from single_flight import Messages, dump_messages, load_messages
+
+# Запросы, которые можно безопасно повторять с заголовком Idempotency-Key
+IDEMPOTENT_ROUTES = {"POST /notes/"}
+IDEMPOTENCY_HEADER = "idempotency-key"
+MAX_KEY_LENGTH = 255
+
+# Продлевает блокировку, только если она всё ещё принадлежит этому запросу
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class IdempotencyKeyReused(Exception):
+    """Ключ уже использован для запроса с другим телом."""
+
+class IdempotencyRequestInProgress(Exception):
+    """Запрос с этим ключом ещё выполняется, и его результат не дождались."""
+
+def request_fingerprint(body: bytes) -> bytes:
+    return hashlib.sha256(body).hexdigest().encode()
+
+class IdempotencyStore:
+    """
+    Ответы на запросы с Idempotency-Key в Redis.
+
+    Первый запрос берёт блокировку SET NX на lock_ttl секунд и продлевает её, пока выполняется обработчик,
+    затем сохраняет статус, заголовки и тело на ttl секунд. Обработчик выполняется только под блокировкой:
+    одновременные повторы ждут результат до lock_ttl секунд (не дольше бюджета запроса) и, не дождавшись,
+    получают IdempotencyRequestInProgress. Поздние повторы получают сохранённый ответ без обращения
+    к обработчику. Ответы 5xx не сохраняются, чтобы запрос можно было повторить.
+    """
+
+    def __init__(self, redis: Redis, prefix: str, ttl: float, lock_ttl: float, poll_interval: float):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.renew_script = redis.register_script(RENEW_LOCK_SCRIPT)
+
+    async def _keep_locked(self, lock_key: str, token: str):
+        # Блокировка не должна истечь, пока обработчик работает, иначе повтор выполнил бы его второй раз
+        try:
+            while True:
+                await asyncio.sleep(self.lock_ttl / 3)
+                if not await self.renew_script(keys=[lock_key], args=[token, int(self.lock_ttl * 1000)]):
+                    logger.warning(f"Idempotency lock {lock_key} lost while the request was running")
+                    return
+        except RedisError as e:
+            logger.warning(f"Idempotency lock {lock_key} not renewed: {e!r}")
+
+    async def _unlock(self, lock_key: str):
+        try:
+            await self.redis.delete(lock_key)
+        except RedisError:
+            pass
+
+    async def _stored(self, result_key: str, fingerprint: bytes) -> Optional[Messages]:
+        data = await self.redis.hgetall(result_key)
+        if not data:
+            return None
+        if data[b"fingerprint"] != fingerprint:
+            raise IdempotencyKeyReused()
+        return load_messages(data)
+
+    async def run(self, key: str, fingerprint: bytes, execute: Callable[[], Awaitable[Messages]]) -> tuple[Messages, bool]:
+        """Возвращает ответ и признак того, что он взят из сохранённых."""
+        result_key = f"{self.prefix}{tagged(key)}"
+        lock_key = f"{result_key}:lock"
+        token = uuid4().hex
+        deadline = time.monotonic() + bounded_timeout(self.lock_ttl)
+        while True:
+            messages = await self._stored(result_key, fingerprint)
+            if messages is not None:
+                return messages, True
+            if await self.redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                break
+            if time.monotonic() >= deadline:
+                raise IdempotencyRequestInProgress()
+            await asyncio.sleep(self.poll_interval)
+
+        renewal = asyncio.create_task(self._keep_locked(lock_key, token))
+        try:
+            # Результат мог появиться между проверкой и взятием блокировки
+            messages = await self._stored(result_key, fingerprint)
+            if messages is not None:
+                await self._unlock(lock_key)
+                return messages, True
+            messages = await execute()
+        except BaseException:
+            await self._unlock(lock_key)
+            raise
+        finally:
+            renewal.cancel()
+
+        # Запись уже выполнена, и ошибка Redis не должна приводить к её повтору
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                if messages[0]["status"] < 500:
+                    pipe.hset(result_key, mapping={**dump_messages(messages), "fingerprint": fingerprint})
+                    pipe.pexpire(result_key, int(self.ttl * 1000))
+                pipe.delete(lock_key)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Idempotent response not stored: {e!r}")
+        return messages, False
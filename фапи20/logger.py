@@ -1,12 +1,38 @@
+import atexit
+import copy
 import logging
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 from datetime import datetime
+from config import settings
+from metrics import LOG_RECORDS_DROPPED
+
+class BoundedQueueHandler(QueueHandler):
+    """Не блокирует event loop: если очередь заполнена, запись отбрасывается и учитывается в метрике."""
+
+    def prepare(self, record):
+        # В отличие от QueueHandler.prepare, traceback остаётся отдельным полем exc_info
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
 
 def setup_logger():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
+    # Запись в stdout (и сериализация в JSON) выполняется в отдельном потоке QueueListener
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.INFO)
 
@@ -15,8 +41,13 @@ def setup_logger():
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(BoundedQueueHandler(log_queue))
 
     return logger
 
-logger = setup_logger() 
\ No newline at end of file
+logger = setup_logger()
@@ -2,17 +2,28 @@ from fastapi import FastAPI, HTTPException, status, Depends
 from fastapi.staticfiles import StaticFiles
 from sqlmodel import select, Session
 from models import User, UserCreate, UserLogin, UserRead
-from database import create_db_and_tables, get_async_session_factory, engine
+from database import get_session, engine, replicas
 from auth import get_password_hash, verify_password, create_access_token, get_current_user, require_role, get_user_by_username
 from routers import notes
 from routers.tasks import send_mock_email
 from routers import websocket
 from prometheus_fastapi_instrumentator import Instrumentator
-from middleware import LoggingMiddleware, RateLimiterMiddleware
+from middleware import (
+    LoggingMiddleware, RateLimiterMiddleware, DeadlineMiddleware, ServerTimingMiddleware, ConcurrencyLimitMiddleware,
+    SingleFlightMiddleware, IdempotencyMiddleware,
+)
+from idempotency import IdempotencyStore
+from single_flight import SingleFlight
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from server_timing import TimedJSONResponse
 from logger import logger
-from redis.asyncio import Redis
+from queries import warm_up
+from startup import coordinate_startup, mark_ready
+from rate_limiter import create_rate_limiter, POLICY_OVERRIDE_PREFIX
+from near_cache import NearCache
+from write_coalescer import write_coalescer
+from redis_config import redis, open_redis, close_redis
 from config import settings
-from typing import AsyncGenerator
 
 app = FastAPI(
     title="FastAPI Notes API",
@@ -23,13 +34,55 @@ app = FastAPI(
         "email": "support@example.com"
     },
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=TimedJSONResponse,
 )
 
-app.add_middleware(LoggingMiddleware)
+if settings.SINGLE_FLIGHT_MODE != "off":
+    app.add_middleware(
+        SingleFlightMiddleware,
+        flight=SingleFlight(
+            redis if settings.SINGLE_FLIGHT_MODE == "redis" else None,
+            prefix=settings.SINGLE_FLIGHT_PREFIX,
+            lock_ttl=settings.SINGLE_FLIGHT_LOCK_TTL,
+            poll_interval=settings.SINGLE_FLIGHT_POLL_MS / 1000,
+        ),
+    )
+app.add_middleware(
+    IdempotencyMiddleware,
+    store=IdempotencyStore(
+        redis,
+        prefix=settings.IDEMPOTENCY_PREFIX,
+        ttl=settings.IDEMPOTENCY_TTL,
+        lock_ttl=settings.IDEMPOTENCY_LOCK_TTL,
+        poll_interval=settings.IDEMPOTENCY_POLL_MS / 1000,
+    ),
+)
 
-redis = Redis.from_url(settings.REDIS_URL)
-app.add_middleware(RateLimiterMiddleware, redis=redis)
+rate_limiter = create_rate_limiter(redis)
+near_cache = NearCache(
+    redis,
+    prefixes=[POLICY_OVERRIDE_PREFIX],
+    max_entries=settings.NEAR_CACHE_MAX_ENTRIES,
+    ping_interval=settings.NEAR_CACHE_PING_INTERVAL,
+) if settings.NEAR_CACHE_ENABLED else None
+app.add_middleware(RateLimiterMiddleware, limiter=rate_limiter, policy_cache=near_cache)
+app.add_middleware(
+    ConcurrencyLimitMiddleware,
+    limiter=AdaptiveConcurrencyLimiter(
+        initial_limit=settings.CONCURRENCY_INITIAL_LIMIT,
+        min_limit=settings.CONCURRENCY_MIN_LIMIT,
+        max_limit=settings.CONCURRENCY_MAX_LIMIT,
+        target_latency=settings.CONCURRENCY_TARGET_LATENCY_MS / 1000,
+        backoff=settings.CONCURRENCY_BACKOFF,
+        queue_size=settings.CONCURRENCY_QUEUE_SIZE,
+        max_queue_time=settings.CONCURRENCY_MAX_QUEUE_MS / 1000,
+    ),
+)
+app.add_middleware(DeadlineMiddleware)
+# Снаружи всех отказов: 429, 503 и 504 тоже должны попадать в access-лог
+app.add_middleware(LoggingMiddleware)
+app.add_middleware(ServerTimingMiddleware)
 
 app.include_router(notes.router)
 app.include_router(websocket.router)
@@ -37,33 +90,28 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 Instrumentator().instrument(app).expose(app)
 
-async_session_factory = get_async_session_factory()
-
-async def get_session() -> AsyncGenerator[Session, None]:
-    async with async_session_factory() as session:
-        yield session
-
-async def create_admin():
-    async with async_session_factory() as session:
-        statement = select(User).where(User.username == "admin")
-        result = await session.exec(statement)
-        admin = result.scalar_one_or_none()
-        if not admin:
-            admin_user = User(
-                username="admin",
-                hashed_password=get_password_hash("adminpass"),
-                role="admin"
-            )
-            session.add(admin_user)
-            await session.commit()
-            logger.info("Admin user created successfully")
+async def warm_up_queries():
+    await warm_up([engine, *replicas.engines])
 
-app.add_event_handler("startup", create_db_and_tables)
-app.add_event_handler("startup", create_admin)
-app.add_event_handler("startup", lambda: logger.info("Application started"))
+app.add_event_handler("startup", open_redis)
+app.add_event_handler("startup", coordinate_startup)
+app.add_event_handler("startup", warm_up_queries)
+app.add_event_handler("startup", replicas.start)
+app.add_event_handler("startup", rate_limiter.start)
+if near_cache is not None:
+    app.add_event_handler("startup", near_cache.start)
+app.add_event_handler("startup", websocket.broadcaster.start)
+app.add_event_handler("startup", mark_ready)
 
 async def shutdown_event():
-    await redis.aclose()
+    await write_coalescer.close()
+    await rate_limiter.close()
+    await websocket.broadcaster.close()
+    if near_cache is not None:
+        await near_cache.close()
+    await close_redis()
+    await replicas.stop()
+    await engine.dispose()
     logger.info("Application shutdown")
 
 @app.get(
@@ -131,6 +179,7 @@ async def register(user: UserCreate, session: Session = Depends(get_session)):
     session.add(new_user)
     await session.commit()
     await session.refresh(new_user)
+    replicas.mark_write(new_user.username)
     logger.info(f"New user registered: {user.username}")
     return UserRead(id=new_user.id, username=new_user.username, role=new_user.role)
 
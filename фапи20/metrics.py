@@ -0,0 +1,167 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Метрики пула соединений с БД (label "pool" — имя пула: primary, replica-0, ...)
+DB_POOL_SIZE = Gauge(
+    "db_pool_size",
+    "Настроенный размер пула соединений",
+    ["pool"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Количество соединений, выданных из пула в данный момент",
+    ["pool"],
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Количество соединений, открытых сверх pool_size",
+    ["pool"],
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds",
+    "Время ожидания свободного соединения из пула",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0),
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total",
+    "Количество запросов, не дождавшихся соединения за pool_timeout",
+    ["pool"],
+)
+
+DB_REPLICA_HEALTHY = Gauge(
+    "db_replica_healthy",
+    "Доступность реплики для чтения (1 — доступна, 0 — исключена из ротации)",
+    ["pool"],
+)
+
+DB_CONNECTIONS_PER_REQUEST = Histogram(
+    "db_connections_per_request",
+    "Количество соединений, взятых из пула за один HTTP-запрос",
+    ["route"],
+    buckets=(0, 1, 2, 3, 4, 6, 8),
+)
+
+DB_STATEMENTS_PER_REQUEST = Histogram(
+    "db_statements_per_request",
+    "Количество SQL-выражений за один HTTP-запрос",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds",
+    "Суммарное время выполнения SQL за один HTTP-запрос",
+    ["route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+DB_SLOW_STATEMENTS = Counter(
+    "db_slow_statements_total",
+    "Количество SQL-выражений дольше DB_SLOW_QUERY_THRESHOLD_MS",
+    ["route"],
+)
+DB_N_PLUS_ONE_REQUESTS = Counter(
+    "db_n_plus_one_requests_total",
+    "Запросы, повторившие одно и то же SQL-выражение больше DB_N_PLUS_ONE_THRESHOLD раз",
+    ["route"],
+)
+
+APP_STARTUP_SECONDS = Gauge(
+    "app_startup_seconds",
+    "Время от импорта приложения до готовности принимать запросы",
+    ["role"],
+)
+
+WRITE_BATCH_SIZE = Histogram(
+    "write_batch_size",
+    "Количество операций записи, зафиксированных одной транзакцией",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+WRITE_BATCH_FLUSH_SECONDS = Histogram(
+    "write_batch_flush_seconds",
+    "Время выполнения и фиксации пакета записей",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+WRITE_BATCH_FALLBACKS = Counter(
+    "write_batch_fallbacks_total",
+    "Пакеты записей, которые пришлось повторить по одной операции",
+)
+
+DEADLINE_EXCEEDED = Counter(
+    "request_deadline_exceeded_total",
+    "Запросы, прерванные по истечении бюджета времени",
+    ["route"],
+)
+
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total",
+    "Записи лога, отброшенные из-за переполненной очереди",
+)
+
+REQUEST_COMPONENT_SECONDS = Histogram(
+    "request_component_seconds",
+    "Время обработки запроса по компонентам (jwt, auth_db, db, ratelimit, serialize, total)",
+    ["component", "route"],
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    "circuit_breaker_state",
+    "Состояние circuit breaker: 0 — замкнут, 1 — пробные вызовы, 2 — разомкнут",
+    ["name"],
+)
+CIRCUIT_BREAKER_REJECTED = Counter(
+    "circuit_breaker_rejected_total",
+    "Вызовы, отклонённые разомкнутым circuit breaker",
+    ["name"],
+)
+
+CONCURRENCY_LIMIT = Gauge(
+    "concurrency_limit",
+    "Текущий адаптивный лимит одновременно обрабатываемых запросов",
+)
+CONCURRENCY_IN_FLIGHT = Gauge(
+    "concurrency_in_flight",
+    "Запросы, обрабатываемые в данный момент",
+)
+CONCURRENCY_SHED = Counter(
+    "concurrency_shed_total",
+    "Запросы, отклонённые ограничителем конкурентности",
+    ["priority", "reason"],
+)
+
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "single_flight_requests_total",
+    "Чтения, прошедшие через single-flight: executed — выполнены, shared — получили чужой ответ",
+    ["route", "outcome"],
+)
+
+IDEMPOTENCY_REQUESTS = Counter(
+    "idempotency_requests_total",
+    "Запросы с Idempotency-Key: executed, replayed, conflict (ключ с другим телом), in_progress (первый ещё выполняется), "
+    "bypassed (Redis недоступен)",
+    ["route", "outcome"],
+)
+
+NEAR_CACHE_REQUESTS = Counter(
+    "near_cache_requests_total",
+    "Чтения через near cache: hit, miss, bypass (ключ не отслеживается или нет соединения отслеживания)",
+    ["result"],
+)
+NEAR_CACHE_INVALIDATIONS = Counter(
+    "near_cache_invalidations_total",
+    "Записи near cache, вытесненные сообщениями об изменении ключей",
+)
+
+WEBSOCKET_CONNECTIONS = Gauge(
+    "websocket_connections",
+    "Открытые WebSocket-соединения, получающие рассылку",
+)
+WEBSOCKET_MESSAGES_DROPPED = Counter(
+    "websocket_messages_dropped_total",
+    "Сообщения рассылки, не доставленные клиенту: drop_oldest, drop_newest, disconnect (переполнение очереди), send_failed",
+    ["reason"],
+)
+
+WEBSOCKET_BROADCAST_BATCH_SIZE = Histogram(
+    "websocket_broadcast_batch_size",
+    "Сообщения WebSocket, опубликованные в Redis одним PUBLISH",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
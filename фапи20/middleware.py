@@ -1,40 +1,375 @@
+import asyncio
+import random
 import time
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
+from typing import Optional
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import DBAPIError
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
 from logger import logger
-from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from config import settings
+from deadlines import request_deadline, bounded_timeout, resolve_route_path
+from metrics import DEADLINE_EXCEEDED, REQUEST_COMPONENT_SECONDS, SINGLE_FLIGHT_REQUESTS, IDEMPOTENCY_REQUESTS
+from server_timing import RequestTimings, request_timings, timed
+from rate_limiter import (
+    RATE_LIMIT_RULES, DEFAULT_RULE, InProcessRateLimiter, LocalRateLimiter, RateLimitResult, RouteRule,
+    apply_policy_overrides, rate_limit_identity,
+)
+from near_cache import NearCache
+from circuit_breaker import CircuitOpenError
+from concurrency_limiter import AdaptiveConcurrencyLimiter, request_priority
+from single_flight import SINGLE_FLIGHT_ROUTES, Messages, SingleFlight, request_key
+from database import READ_ONLY_METHODS
+from idempotency import (
+    IDEMPOTENCY_HEADER, IDEMPOTENT_ROUTES, MAX_KEY_LENGTH, IdempotencyKeyReused, IdempotencyRequestInProgress,
+    IdempotencyStore, request_fingerprint,
+)
 
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        
-        response = await call_next(request)
-        
-        process_time = time.time() - start_time
-        logger.info(f"{request.method} {request.url.path} completed in {process_time:.2f}s")
-        
-        return response 
-
-class RateLimiterMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, redis):
-        super().__init__(app)
-        self.redis = redis
-
-    async def dispatch(self, request: Request, call_next):
-        client_ip = request.client.host
-        key = f"rate_limit:{client_ip}"
-        
-        current = await self.redis.get(key)
-        if current is None:
-            await self.redis.set(key, 1, ex=60)
-        elif int(current) >= 100:
-            logger.warning(f"Rate limit exceeded for IP: {client_ip}")
-            return HTTPException(
+# SQLSTATE query_canceled: PostgreSQL прервал запрос по statement_timeout
+QUERY_CANCELED = "57014"
+
+class LoggingMiddleware:
+    """
+    Access-лог со структурированными полями.
+
+    Успешные запросы попадают в лог с вероятностью LOG_ACCESS_SAMPLE_RATE. Ответы 4xx/5xx, исключения
+    и запросы дольше LOG_SLOW_REQUEST_MS пишутся всегда.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            self.log(scope, status_code, start_time, exc_info=True)
+            raise
+        self.log(scope, status_code, start_time)
+
+    @staticmethod
+    def log(scope: Scope, status_code: int, start_time: float, exc_info: bool = False):
+        duration_ms = (time.perf_counter() - start_time) * 1000
+        slow = duration_ms >= settings.LOG_SLOW_REQUEST_MS
+        if status_code < 400 and not slow and not exc_info and random.random() >= settings.LOG_ACCESS_SAMPLE_RATE:
+            return
+
+        fields = {
+            "method": scope["method"],
+            # Запросы, отклонённые до роутера, тоже получают шаблон маршрута
+            "route": resolve_route_path(scope),
+            "status": status_code,
+            "duration_ms": round(duration_ms, 2),
+        }
+        if exc_info or status_code >= 500:
+            logger.error("Request failed", extra=fields, exc_info=exc_info)
+        elif slow:
+            logger.warning("Slow request", extra=fields)
+        else:
+            logger.info("Request completed", extra=fields)
+
+class RateLimiterMiddleware:
+    def __init__(self, app: ASGIApp, limiter, policy_cache: Optional[NearCache] = None):
+        self.app = app
+        self.limiter = limiter
+        self.policy_cache = policy_cache
+        self.fallback = InProcessRateLimiter()
+        # LocalRateLimiter обычно отвечает из памяти и сам ограничивает ожидание сверки с Redis:
+        # общий таймаут нужен, только если на каждый запрос может понадобиться Redis
+        self.bounded = not isinstance(limiter, LocalRateLimiter) or policy_cache is not None
+
+    async def _hit(self, identity: str, rule: RouteRule) -> RateLimitResult:
+        if self.policy_cache is not None:
+            rule = await apply_policy_overrides(rule, self.policy_cache)
+        return await self.limiter.hit(identity, rule)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        identity = rate_limit_identity(Request(scope))
+        rule = RATE_LIMIT_RULES.get(f"{scope['method']} {resolve_route_path(scope)}", DEFAULT_RULE)
+
+        try:
+            with timed("ratelimit"):
+                if self.bounded:
+                    result = await asyncio.wait_for(
+                        self._hit(identity, rule), bounded_timeout(settings.REDIS_OPERATION_TIMEOUT)
+                    )
+                else:
+                    result = await self._hit(identity, rule)
+        except (asyncio.TimeoutError, RedisError) as e:
+            # Медленный или недоступный Redis не должен съедать бюджет запроса: ограничиваем в памяти воркера
+            if not isinstance(e, CircuitOpenError):
+                logger.warning(f"Rate limiter fell back to in-process limiting for {identity}: {e!r}")
+            result = await self.fallback.hit(identity, rule)
+
+        if not result.allowed:
+            logger.warning(f"Rate limit exceeded for {identity}")
+            response = JSONResponse(
                 status_code=429,
-                detail="Too many requests. Please try again later."
+                content={"detail": "Too many requests. Please try again later."},
+                headers=result.headers(),
             )
-        else:
-            await self.redis.incr(key)
-            
-        return await call_next(request) 
\ No newline at end of file
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).update(result.headers())
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+class DeadlineMiddleware:
+    """
+    Ограничивает время обработки запроса.
+
+    Бюджет берётся из REQUEST_TIMEOUTS по шаблону маршрута (или REQUEST_TIMEOUT) и может быть
+    уменьшен клиентом заголовком REQUEST_TIMEOUT_HEADER (в секундах). По истечении бюджета
+    обработчик отменяется и клиент получает 504.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = resolve_route_path(scope)
+        timeout = settings.REQUEST_TIMEOUTS.get(route, settings.REQUEST_TIMEOUT)
+        header = Request(scope).headers.get(settings.REQUEST_TIMEOUT_HEADER)
+        if header:
+            try:
+                timeout = min(timeout, max(float(header), 0.0))
+            except ValueError:
+                pass
+        request_deadline.set(time.monotonic() + timeout)
+
+        response_started = False
+
+        async def send_wrapper(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await asyncio.wait_for(self.app(scope, receive, send_wrapper), timeout)
+        except (asyncio.TimeoutError, DBAPIError) as e:
+            if isinstance(e, DBAPIError) and getattr(e.orig, "sqlstate", None) != QUERY_CANCELED:
+                raise
+            DEADLINE_EXCEEDED.labels(route=route).inc()
+            logger.warning(f"Deadline of {timeout:.2f}s exceeded for {scope['method']} {scope['path']}")
+            if not response_started:
+                response = JSONResponse(status_code=504, content={"detail": "Request deadline exceeded"})
+                await response(scope, receive, send)
+
+class ServerTimingMiddleware:
+    """
+    Разбивка времени запроса по компонентам.
+
+    Всегда пишется в гистограмму request_component_seconds. В заголовке Server-Timing отдаётся
+    только администраторам или всем при SERVER_TIMING_ENABLED.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        timings = RequestTimings(expose=settings.SERVER_TIMING_ENABLED)
+        request_timings.set(timings)
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                timings.add("total", time.perf_counter() - start_time)
+                if timings.expose:
+                    MutableHeaders(scope=message).append("Server-Timing", timings.header())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            for component, seconds in timings.durations.items():
+                REQUEST_COMPONENT_SECONDS.labels(component=component, route=route).observe(seconds)
+
+class ConcurrencyLimitMiddleware:
+    """
+    Сброс нагрузки: запросы сверх адаптивного лимита ждут в очереди, а при её переполнении
+    или слишком долгом ожидании получают 503 с Retry-After.
+    """
+
+    def __init__(self, app: ASGIApp, limiter: AdaptiveConcurrencyLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Приоритет даёт только валидный токен: любой клиент может прислать произвольный Authorization
+        authenticated = rate_limit_identity(Request(scope)).startswith("user:")
+        priority = request_priority(scope["method"], resolve_route_path(scope), authenticated)
+        if not await self.limiter.acquire(priority):
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Service overloaded. Please try again later."},
+                headers={"Retry-After": str(settings.CONCURRENCY_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.limiter.release(time.perf_counter() - start_time, failed=status_code >= 500)
+
+class SingleFlightMiddleware:
+    """Одинаковые одновременные GET одного пользователя выполняются один раз (см. single_flight.py)."""
+
+    def __init__(self, app: ASGIApp, flight: SingleFlight):
+        self.app = app
+        self.flight = flight
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        identity = rate_limit_identity(Request(scope))
+        if scope["method"] not in READ_ONLY_METHODS:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                self.flight.invalidate(identity)
+            return
+
+        route = resolve_route_path(scope)
+        if scope["method"] != "GET" or route not in SINGLE_FLIGHT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        async def execute() -> Messages:
+            messages = []
+
+            async def capture(message: Message):
+                messages.append(message)
+
+            await self.app(scope, receive, capture)
+            return messages
+
+        messages, shared = await self.flight.run(request_key(identity, scope), execute)
+        SINGLE_FLIGHT_REQUESTS.labels(route=route, outcome="shared" if shared else "executed").inc()
+        for message in messages:
+            # Внешние middleware дописывают заголовки в сообщение, поэтому каждому запросу — своя копия
+            await send(dict(message))
+
+class IdempotencyMiddleware:
+    """Повторы запросов с одинаковым Idempotency-Key получают первый ответ (см. idempotency.py)."""
+
+    def __init__(self, app: ASGIApp, store: IdempotencyStore):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        route = f"{scope['method']} {resolve_route_path(scope)}"
+        if idempotency_key is None or route not in IDEMPOTENT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            response = JSONResponse(status_code=400, content={"detail": "Invalid Idempotency-Key"})
+            await response(scope, receive, send)
+            return
+
+        body = await request.body()
+        body_sent = False
+
+        async def replay_body() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        async def execute() -> Messages:
+            messages = []
+
+            async def capture(message: Message):
+                messages.append(message)
+
+            await self.app(scope, replay_body, capture)
+            return messages
+
+        key = f"{rate_limit_identity(request)}:{route}:{idempotency_key}"
+        try:
+            messages, replayed = await self.store.run(key, request_fingerprint(body), execute)
+        except IdempotencyKeyReused:
+            IDEMPOTENCY_REQUESTS.labels(route=route, outcome="conflict").inc()
+            response = JSONResponse(
+                status_code=422, content={"detail": "Idempotency-Key has already been used with a different request"}
+            )
+            await response(scope, receive, send)
+            return
+        except IdempotencyRequestInProgress:
+            IDEMPOTENCY_REQUESTS.labels(route=route, outcome="in_progress").inc()
+            response = JSONResponse(
+                status_code=409,
+                content={"detail": "A request with this Idempotency-Key is still in progress"},
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+        except RedisError as e:
+            # Без Redis идемпотентность не гарантируется, но запрос выполняется
+            if not isinstance(e, CircuitOpenError):
+                logger.warning(f"Idempotency store unavailable: {e!r}")
+            IDEMPOTENCY_REQUESTS.labels(route=route, outcome="bypassed").inc()
+            await self.app(scope, replay_body, send)
+            return
+
+        IDEMPOTENCY_REQUESTS.labels(route=route, outcome="replayed" if replayed else "executed").inc()
+        for message in messages:
+            message = dict(message)
+            if replayed and message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("Idempotent-Replayed", "true")
+            await send(message)
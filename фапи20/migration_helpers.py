@@ -0,0 +1,121 @@
+"""
+Помощники для миграций, которые не блокируют большие таблицы.
+
+Используются внутри alembic-ревизий. env.py запускает каждую ревизию в отдельной
+транзакции, поэтому функции ниже могут выходить из неё через autocommit_block().
+"""
+import logging
+import time
+from contextlib import contextmanager
+from alembic import op, context
+from sqlalchemy import text
+
+# Дочерний логгер alembic: в CLI его настраивает alembic.ini, в приложении — logger.py
+logger = logging.getLogger("alembic.migration_helpers")
+
+DEFAULT_LOCK_TIMEOUT = "5s"
+
+def quote(name: str) -> str:
+    return op.get_bind().dialect.identifier_preparer.quote(name)
+
+def is_postgresql() -> bool:
+    return context.get_context().dialect.name == "postgresql"
+
+@contextmanager
+def lock_timeout(timeout: str = DEFAULT_LOCK_TIMEOUT):
+    """
+    Ограничивает ожидание блокировки: DDL, вставший в очередь за долгой транзакцией,
+    иначе блокирует все последующие запросы к таблице.
+    """
+    if not is_postgresql():
+        yield
+        return
+    op.execute(f"SET lock_timeout = '{timeout}'")
+    try:
+        yield
+    finally:
+        op.execute("RESET lock_timeout")
+
+def create_index_concurrently(index_name: str, table_name: str, columns: list[str], unique: bool = False,
+                              timeout: str = DEFAULT_LOCK_TIMEOUT):
+    """CREATE INDEX CONCURRENTLY вне транзакции; невалидный индекс от прерванной попытки пересоздаётся."""
+    with context.get_context().autocommit_block():
+        if is_postgresql() and not context.is_offline_mode():
+            invalid = op.get_bind().execute(
+                text(
+                    "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE c.relname = :name AND NOT i.indisvalid"
+                ),
+                {"name": index_name},
+            ).first()
+            if invalid:
+                logger.warning(f"Dropping invalid index {index_name} left by an interrupted migration")
+                op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+        with lock_timeout(timeout):
+            op.create_index(
+                index_name, table_name, columns,
+                unique=unique, postgresql_concurrently=True, if_not_exists=True,
+            )
+
+def drop_index_concurrently(index_name: str, table_name: str, timeout: str = DEFAULT_LOCK_TIMEOUT):
+    with context.get_context().autocommit_block():
+        with lock_timeout(timeout):
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+
+def batched_backfill(table_name: str, set_clause: str, where: str = "TRUE", batch_size: int = 10_000,
+                     pause: float = 0.05, key: str = "id"):
+    """
+    Обновляет строки диапазонами первичного ключа, фиксируя каждый пакет отдельно.
+
+    Каждый пакет держит блокировки строк недолго, а пауза между пакетами даёт репликам
+    и autovacuum догнать изменения. Прогресс пишется в лог в процентах от диапазона ключей.
+    """
+    table, column = quote(table_name), quote(key)
+    update = f"UPDATE {table} SET {set_clause} WHERE {column} >= :low AND {column} < :high AND ({where})"
+
+    if context.is_offline_mode():
+        op.execute(f"UPDATE {table} SET {set_clause} WHERE {where}")
+        return
+
+    with context.get_context().autocommit_block():
+        bind = op.get_bind()
+        low, high = bind.execute(text(f"SELECT min({column}), max({column}) FROM {table}")).one()
+        if low is None:
+            return
+        updated = 0
+        started = time.monotonic()
+        for batch_low in range(low, high + 1, batch_size):
+            result = bind.execute(text(update), {"low": batch_low, "high": batch_low + batch_size})
+            updated += result.rowcount
+            done = min(batch_low + batch_size - low, high - low + 1) / (high - low + 1)
+            logger.info(
+                f"Backfill {table_name}: {done:.1%}",
+                extra={"table": table_name, "rows_updated": updated, "elapsed": round(time.monotonic() - started, 1)},
+            )
+            if pause:
+                time.sleep(pause)
+
+def add_check_constraint_not_valid(constraint_name: str, table_name: str, condition: str,
+                                   timeout: str = DEFAULT_LOCK_TIMEOUT):
+    """Добавляет CHECK без проверки существующих строк; проверить их позже — validate_constraint()."""
+    with lock_timeout(timeout):
+        op.execute(
+            f"ALTER TABLE {quote(table_name)} ADD CONSTRAINT {quote(constraint_name)} "
+            f"CHECK ({condition}) NOT VALID"
+        )
+
+def add_foreign_key_not_valid(constraint_name: str, source_table: str, referent_table: str,
+                              local_columns: list[str], remote_columns: list[str],
+                              timeout: str = DEFAULT_LOCK_TIMEOUT):
+    local = ", ".join(quote(column) for column in local_columns)
+    remote = ", ".join(quote(column) for column in remote_columns)
+    with lock_timeout(timeout):
+        op.execute(
+            f"ALTER TABLE {quote(source_table)} ADD CONSTRAINT {quote(constraint_name)} "
+            f"FOREIGN KEY ({local}) REFERENCES {quote(referent_table)} ({remote}) NOT VALID"
+        )
+
+def validate_constraint(constraint_name: str, table_name: str):
+    """VALIDATE CONSTRAINT берёт только SHARE UPDATE EXCLUSIVE и не мешает чтению и записи."""
+    with context.get_context().autocommit_block():
+        op.execute(f"ALTER TABLE {quote(table_name)} VALIDATE CONSTRAINT {quote(constraint_name)}")
@@ -75,6 +75,7 @@ class Note(SQLModel, table=True):
     )
     owner_id: int = Field(
         foreign_key="user.id",
+        index=True,
         description="ID владельца заметки"
     )
     owner: Optional["User"] = Relationship(back_populates="notes")
@@ -0,0 +1,131 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Optional, Union
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from logger import logger
+from metrics import NEAR_CACHE_REQUESTS, NEAR_CACHE_INVALIDATIONS
+from redis_config import shard_clients
+from redis_sharding import ShardedRedis
+
+class NearCache:
+    """
+    Кэш редко меняющихся ключей Redis в памяти воркера, согласованный через client tracking.
+
+    Отдельное соединение по RESP3 включает CLIENT TRACKING в режиме BCAST для prefixes: Redis присылает
+    в него push-сообщение invalidate при каждом изменении ключа с этими префиксами, и ключ вытесняется.
+    С шардированным Redis такое соединение открывается к каждому шарду. Пока установлены не все,
+    кэш не используется, а при потере любого очищается целиком: сообщения об изменениях за это время потеряны.
+    """
+
+    def __init__(
+        self, redis: Union[aioredis.Redis, ShardedRedis], prefixes: list[str], max_entries: int, ping_interval: float
+    ):
+        self.redis = redis
+        self.prefixes = tuple(prefixes)
+        self.max_entries = max_entries
+        self.ping_interval = ping_interval
+        self.entries: dict[str, Any] = {}
+        self.loading: dict[str, object] = {}
+        self.shards = shard_clients(redis)
+        self.connected: set[int] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def tracking(self) -> bool:
+        return len(self.connected) == len(self.shards)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._read(key, self.redis.get)
+
+    async def hgetall(self, key: str) -> dict[bytes, bytes]:
+        return await self._read(key, self.redis.hgetall)
+
+    async def _read(self, key: str, load: Callable[[str], Awaitable[Any]]) -> Any:
+        if not self.tracking or not key.startswith(self.prefixes):
+            NEAR_CACHE_REQUESTS.labels(result="bypass").inc()
+            return await load(key)
+        if key in self.entries:
+            NEAR_CACHE_REQUESTS.labels(result="hit").inc()
+            return self.entries[key]
+
+        NEAR_CACHE_REQUESTS.labels(result="miss").inc()
+        # Если ключ изменится, пока ответ в пути, инвалидация снимет отметку, и устаревшее значение не сохранится
+        marker = self.loading[key] = object()
+        try:
+            value = await load(key)
+        finally:
+            fresh = self.loading.get(key) is marker
+            if fresh:
+                del self.loading[key]
+        if fresh and self.tracking:
+            if len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+            self.entries[key] = value
+        return value
+
+    def invalidate(self, keys: Optional[list[str]] = None):
+        """None — сбросить всё (FLUSHALL на сервере или потеря соединения)."""
+        if keys is None:
+            NEAR_CACHE_INVALIDATIONS.inc(len(self.entries))
+            self.entries.clear()
+            self.loading.clear()
+            return
+        for key in keys:
+            if self.entries.pop(key, None) is not None:
+                NEAR_CACHE_INVALIDATIONS.inc()
+            self.loading.pop(key, None)
+
+    async def _on_invalidate(self, message: list):
+        keys = message[1]
+        self.invalidate(None if keys is None else [key.decode() if isinstance(key, bytes) else key for key in keys])
+
+    async def _connect(self, shard: aioredis.Redis) -> aioredis.Connection:
+        pool = shard.connection_pool
+        connection = pool.connection_class(
+            **{**pool.connection_kwargs, "protocol": 3, "socket_timeout": None, "health_check_interval": 0}
+        )
+        await connection.connect()
+        connection._parser.set_invalidation_push_handler(self._on_invalidate)
+        prefixes = [arg for prefix in self.prefixes for arg in ("PREFIX", prefix)]
+        await connection.send_command("CLIENT", "TRACKING", "ON", "BCAST", *prefixes)
+        await connection.read_response()
+        return connection
+
+    async def _listen(self, index: int):
+        while True:
+            connection = None
+            try:
+                connection = await self._connect(self.shards[index])
+                self.connected.add(index)
+                logger.info(f"Near cache tracking {', '.join(self.prefixes)} on shard {index}")
+                awaiting_pong = False
+                while True:
+                    # Инвалидации обрабатывает _on_invalidate внутри read_response; PING выявляет оборванное соединение
+                    response = await connection.read_response(timeout=self.ping_interval, push_request=True)
+                    if response is None:
+                        if awaiting_pong:
+                            raise RedisError("Near cache tracking connection stopped responding")
+                        await connection.send_command("PING")
+                        awaiting_pong = True
+                    elif response in (b"PONG", "PONG"):
+                        awaiting_pong = False
+            except asyncio.CancelledError:
+                raise
+            except (RedisError, OSError) as e:
+                logger.warning(f"Near cache tracking lost, bypassing cache: {e!r}")
+            finally:
+                self.connected.discard(index)
+                self.invalidate()
+                if connection is not None:
+                    await connection.disconnect(nowait=True)
+            await asyncio.sleep(self.ping_interval)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._listen(index)) for index in range(len(self.shards))]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
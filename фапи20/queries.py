@@ -0,0 +1,44 @@
+from sqlalchemy import bindparam
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import User, Note
+
+# Реестр горячих запросов. Выражения строятся один раз при импорте и используют
+# именованные параметры, поэтому SQLAlchemy компилирует каждое из них один раз на движок,
+# а asyncpg переиспользует подготовленное выражение внутри соединения.
+
+USER_BY_USERNAME = select(User).where(User.username == bindparam("username"))
+
+NOTE_BY_ID_AND_OWNER = select(Note).where(
+    Note.id == bindparam("note_id"),
+    Note.owner_id == bindparam("owner_id"),
+)
+
+NOTES_PAGE_BY_OWNER = (
+    select(Note)
+    .where(Note.owner_id == bindparam("owner_id"))
+    .offset(bindparam("skip"))
+    .limit(bindparam("limit"))
+)
+
+NOTES_SEARCH_PAGE_BY_OWNER = (
+    select(Note)
+    .where(Note.owner_id == bindparam("owner_id"), Note.text.ilike(bindparam("pattern")))
+    .offset(bindparam("skip"))
+    .limit(bindparam("limit"))
+)
+
+HOT_QUERIES = [
+    (USER_BY_USERNAME, {"username": ""}),
+    (NOTE_BY_ID_AND_OWNER, {"note_id": 0, "owner_id": 0}),
+    (NOTES_PAGE_BY_OWNER, {"owner_id": 0, "skip": 0, "limit": 1}),
+    (NOTES_SEARCH_PAGE_BY_OWNER, {"owner_id": 0, "pattern": "", "skip": 0, "limit": 1}),
+]
+
+async def warm_up(engines: list[AsyncEngine]):
+    """Компилирует горячие запросы при старте, чтобы первый запрос пользователя не платил за компиляцию."""
+    for engine in engines:
+        async with AsyncSession(engine) as session:
+            for statement, params in HOT_QUERIES:
+                await session.execute(statement, params)
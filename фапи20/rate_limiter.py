@@ -0,0 +1,371 @@
+import asyncio
+import math
+import time
+from dataclasses import dataclass, replace
+from ipaddress import ip_address, ip_network
+from typing import Optional
+from fastapi import Request
+from jose import JWTError, jwt
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from config import settings
+from deadlines import bounded_timeout
+from logger import logger
+from circuit_breaker import CircuitOpenError
+from near_cache import NearCache
+from redis_config import incrby_many
+from redis_sharding import tagged
+
+# Token bucket для нескольких бакетов сразу: KEYS[i] — бакет, ARGV — тройки (capacity, rate, cost),
+# rate в токенах в миллисекунду. Запрос пропускается, только если хватает токенов во всех бакетах,
+# и тогда списывается из всех. Время берётся у Redis, чтобы часы воркеров не влияли на результат.
+# Возвращает признак пропуска и данные самого узкого бакета: limit, remaining, retry_after, reset (мс).
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+
+local buckets = {}
+local allowed = 1
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 2])
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+    if tokens < cost then
+        allowed = 0
+    end
+    buckets[i] = {capacity, rate, cost, tokens}
+end
+
+local limit, remaining, retry_after, reset = 0, -1, 0, 0
+for i, key in ipairs(KEYS) do
+    local capacity, rate, cost, tokens = unpack(buckets[i])
+    if allowed == 1 then
+        tokens = tokens - cost
+    elseif tokens < cost then
+        retry_after = math.max(retry_after, math.ceil((cost - tokens) / rate))
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate))
+    if remaining < 0 or tokens < remaining then
+        limit, remaining = capacity, math.floor(tokens)
+    end
+    reset = math.max(reset, math.ceil((capacity - tokens) / rate))
+end
+return {allowed, limit, remaining, retry_after, reset}
+"""
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    """Бакет: capacity токенов, полностью восстанавливаемых за window секунд. Правила с одним name делят бакет."""
+    name: str
+    capacity: int
+    window: float
+
+DEFAULT_POLICY = RateLimitPolicy("default", settings.RATE_LIMIT_REQUESTS, settings.RATE_LIMIT_WINDOW)
+AUTH_POLICY = RateLimitPolicy("auth", settings.RATE_LIMIT_AUTH_REQUESTS, settings.RATE_LIMIT_AUTH_WINDOW)
+
+@dataclass(frozen=True)
+class RouteRule:
+    """Стоимость маршрута в общем бакете base и дополнительные бакеты (по 1 токену за запрос)."""
+    cost: int = 1
+    policies: tuple[RateLimitPolicy, ...] = ()
+    base: RateLimitPolicy = DEFAULT_POLICY
+
+    def buckets(self) -> list[tuple[RateLimitPolicy, int]]:
+        return [(self.base, self.cost)] + [(policy, 1) for policy in self.policies]
+
+# Ключ — "МЕТОД шаблон_маршрута"; маршруты, которых нет в таблице, стоят 1 токен
+RATE_LIMIT_RULES: dict[str, RouteRule] = {
+    "POST /login": RouteRule(cost=5, policies=(AUTH_POLICY,)),     # bcrypt
+    "POST /register": RouteRule(cost=5, policies=(AUTH_POLICY,)),  # bcrypt
+    "GET /notes/": RouteRule(cost=2),                               # страницы и поиск по ILIKE
+    "POST /trigger-task": RouteRule(cost=3),
+}
+DEFAULT_RULE = RouteRule()
+
+# Переопределение политики без перезапуска: HSET ratelimit:policy:<name> capacity <токены> window <секунды>.
+# Читается на каждом запросе, поэтому учитывается только при включённом near cache.
+POLICY_OVERRIDE_PREFIX = f"{settings.RATE_LIMIT_PREFIX}policy:"
+
+async def apply_policy_overrides(rule: RouteRule, cache: NearCache) -> RouteRule:
+    async def resolve(policy: RateLimitPolicy) -> RateLimitPolicy:
+        override = await cache.hgetall(f"{POLICY_OVERRIDE_PREFIX}{policy.name}")
+        if not override:
+            return policy
+        return RateLimitPolicy(
+            policy.name,
+            int(override.get(b"capacity", policy.capacity)),
+            float(override.get(b"window", policy.window)),
+        )
+
+    return replace(rule, base=await resolve(rule.base), policies=tuple([await resolve(p) for p in rule.policies]))
+
+TRUSTED_PROXIES = [ip_network(proxy) for proxy in settings.RATE_LIMIT_TRUSTED_PROXIES]
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def client_ip(request: Request) -> str:
+    """
+    IP клиента с учётом X-Forwarded-For.
+
+    Заголовку верим, только если запрос пришёл от доверенного прокси. Адреса перебираются справа
+    налево, и берётся первый адрес, который не является доверенным прокси: всё левее мог подставить клиент.
+    """
+    peer = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for value in request.headers.getlist("x-forwarded-for") for hop in value.split(",")]
+    hops = [hop for hop in hops if hop]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+def rate_limit_identity(request: Request) -> str:
+    """Пользователь из валидного JWT, иначе IP клиента. Запоминается в scope, чтобы не разбирать токен повторно."""
+    if "identity" in request.scope:
+        return request.scope["identity"]
+    identity = f"ip:{client_ip(request)}"
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            username = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]).get("sub")
+        except JWTError:
+            username = None
+        if username:
+            identity = f"user:{username}"
+    request.scope["identity"] = identity
+    return identity
+
+@dataclass
+class RateLimitResult:
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float
+    reset: float
+
+    def headers(self) -> dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(math.ceil(self.reset)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil(self.retry_after))
+        return headers
+
+class RedisRateLimiter:
+    """
+    Точное ограничение частоты запросов: все бакеты правила проверяются одним вызовом скрипта.
+
+    Скрипт загружается в Redis один раз и дальше вызывается через EVALSHA.
+    """
+
+    def __init__(self, redis: Redis, prefix: str):
+        self.prefix = prefix
+        self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def hit(self, identity: str, rule: RouteRule = DEFAULT_RULE) -> RateLimitResult:
+        keys, args = [], []
+        for policy, cost in rule.buckets():
+            keys.append(f"{self.prefix}{policy.name}:{tagged(identity)}")
+            args += [policy.capacity, policy.capacity / (policy.window * 1000), cost]
+        allowed, limit, remaining, retry_after_ms, reset_ms = await self.script(keys=keys, args=args)
+        return RateLimitResult(
+            allowed=bool(allowed),
+            limit=int(limit),
+            remaining=int(remaining),
+            retry_after=int(retry_after_ms) / 1000,
+            reset=int(reset_ms) / 1000,
+        )
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+class InProcessRateLimiter:
+    """
+    Token bucket в памяти воркера, без Redis. Используется, пока Redis недоступен:
+    каждый воркер ограничивает клиента сам, поэтому общий лимит умножается на число воркеров.
+    """
+
+    def __init__(self, max_buckets: int = 100_000):
+        self.max_buckets = max_buckets
+        self.buckets: dict[str, tuple[float, float]] = {}
+
+    def _prune(self, now: float):
+        # Бакеты, которые уже успели восстановиться полностью, ничем не отличаются от отсутствующих
+        full = [key for key, (_, ts) in self.buckets.items() if now - ts >= DEFAULT_POLICY.window]
+        for key in full:
+            del self.buckets[key]
+
+    async def hit(self, identity: str, rule: RouteRule = DEFAULT_RULE) -> RateLimitResult:
+        now = time.monotonic()
+        if len(self.buckets) >= self.max_buckets:
+            self._prune(now)
+
+        state = []
+        for policy, cost in rule.buckets():
+            key = f"{policy.name}:{identity}"
+            rate = policy.capacity / policy.window
+            tokens, ts = self.buckets.get(key, (policy.capacity, now))
+            state.append((key, policy, cost, rate, min(policy.capacity, tokens + (now - ts) * rate)))
+
+        allowed = all(tokens >= cost for _, _, cost, _, tokens in state)
+        limit, remaining, retry_after, reset = 0, None, 0.0, 0.0
+        for key, policy, cost, rate, tokens in state:
+            if allowed:
+                tokens -= cost
+            elif tokens < cost:
+                retry_after = max(retry_after, (cost - tokens) / rate)
+            self.buckets[key] = (tokens, now)
+            if remaining is None or tokens < remaining:
+                limit, remaining = policy.capacity, tokens
+            reset = max(reset, (policy.capacity - tokens) / rate)
+        return RateLimitResult(allowed, limit, int(remaining), retry_after, reset)
+
+@dataclass
+class LocalBucket:
+    policy: RateLimitPolicy
+    window: int
+    lease: int         # локальный запас, который воркер может выдать между сверками
+    tokens: int        # сколько ещё можно выдать без обращения к Redis
+    pending: int = 0   # выдано этим воркером и ещё не отправлено в Redis
+    total: int = 0     # израсходовано всеми воркерами по данным последней сверки
+
+class LocalRateLimiter:
+    """
+    Приблизительное распределённое ограничение без обращения к Redis на каждый запрос.
+
+    Общий расход бакета считается в Redis по фиксированным окнам policy.window секунд. Воркер выдаёт
+    токены из локального запаса (не больше lease), а израсходованное отправляет пачкой INCRBY раз в
+    sync_interval секунд и в ответ узнаёт расход остальных воркеров. В Redis ходит только сверка
+    и запрос, которому не хватило локального запаса; его ожидание сверки ограничено operation_timeout
+    (и остатком бюджета запроса), после чего hit бросает asyncio.TimeoutError, а сверка продолжается.
+
+    Превышение ограничено: за окно бакет пропускает не больше capacity + (воркеров - 1) * lease токенов.
+    """
+
+    def __init__(self, redis: Redis, prefix: str, sync_interval: float, lease: int, operation_timeout: float):
+        self.redis = redis
+        self.prefix = prefix
+        self.sync_interval = sync_interval
+        self.lease = lease
+        self.operation_timeout = operation_timeout
+        self.buckets: dict[str, LocalBucket] = {}
+        self._sync: Optional[asyncio.Future] = None
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def _bucket(self, key: str, policy: RateLimitPolicy, cost: int, now: float) -> LocalBucket:
+        window = int(now // policy.window)
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.window != window:
+            # Неотправленный расход прошлого окна на новое окно не влияет
+            lease = min(max(self.lease, cost), policy.capacity)
+            bucket = self.buckets[key] = LocalBucket(policy, window, lease=lease, tokens=lease)
+        return bucket
+
+    async def hit(self, identity: str, rule: RouteRule = DEFAULT_RULE) -> RateLimitResult:
+        now = time.time()
+        keys = [(f"{self.prefix}{policy.name}:{tagged(identity)}", policy, cost) for policy, cost in rule.buckets()]
+        if any(self._bucket(key, policy, cost, now).tokens < cost for key, policy, cost in keys):
+            await asyncio.wait_for(self.sync(), bounded_timeout(self.operation_timeout))
+
+        buckets = [(self._bucket(key, policy, cost, now), cost) for key, policy, cost in keys]
+        allowed = all(bucket.tokens >= cost for bucket, cost in buckets)
+        if allowed:
+            for bucket, cost in buckets:
+                bucket.tokens -= cost
+                bucket.pending += cost
+
+        def remaining(bucket: LocalBucket) -> int:
+            return max(bucket.policy.capacity - bucket.total - bucket.pending, 0)
+
+        def reset(bucket: LocalBucket) -> float:
+            return (bucket.window + 1) * bucket.policy.window - now
+
+        tightest = min((bucket for bucket, _ in buckets), key=remaining)
+        exhausted = [reset(bucket) for bucket, cost in buckets if bucket.tokens < cost]
+        return RateLimitResult(
+            allowed=allowed,
+            limit=tightest.policy.capacity,
+            remaining=remaining(tightest),
+            retry_after=0 if allowed else max(exhausted),
+            reset=max(reset(bucket) for bucket, _ in buckets),
+        )
+
+    async def sync(self):
+        """Сверка с Redis; параллельные вызовы ждут одну и ту же сверку."""
+        if self._sync is None:
+            self._sync = asyncio.ensure_future(self._reconcile())
+            self._sync.add_done_callback(lambda _: setattr(self, "_sync", None))
+        await asyncio.shield(self._sync)
+
+    async def _reconcile(self):
+        now = time.time()
+        for key in [k for k, b in self.buckets.items() if b.window != int(now // b.policy.window)]:
+            del self.buckets[key]
+
+        batch = [
+            (key, bucket, bucket.pending)
+            for key, bucket in self.buckets.items()
+            if bucket.pending or bucket.tokens < bucket.lease
+        ]
+        if not batch:
+            return
+
+        totals = await incrby_many(self.redis, [
+            (f"{key}:{bucket.window}", sent, math.ceil(bucket.policy.window * 2)) for key, bucket, sent in batch
+        ])
+
+        for (_, bucket, sent), total in zip(batch, totals):
+            bucket.pending -= sent
+            bucket.total = total
+            bucket.tokens = max(min(bucket.lease, bucket.policy.capacity - total - bucket.pending), 0)
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except CircuitOpenError:
+                pass
+            except Exception as e:
+                logger.error(f"Rate limiter sync failed: {str(e)}")
+
+    def start(self):
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def close(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        try:
+            await self.sync()
+        except RedisError as e:
+            # Остановка приложения не должна прерываться: неотправленный расход просто теряется
+            logger.warning(f"Rate limiter final sync failed: {e!r}")
+
+def create_rate_limiter(redis: Redis):
+    if settings.RATE_LIMIT_MODE == "local":
+        return LocalRateLimiter(
+            redis,
+            prefix=settings.RATE_LIMIT_PREFIX,
+            sync_interval=settings.RATE_LIMIT_SYNC_INTERVAL,
+            lease=settings.RATE_LIMIT_LOCAL_LEASE,
+            operation_timeout=settings.REDIS_OPERATION_TIMEOUT,
+        )
+    return RedisRateLimiter(redis, prefix=settings.RATE_LIMIT_PREFIX)
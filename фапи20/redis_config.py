@@ -1,15 +1,116 @@
 import os
+from typing import Optional, Union
 import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
 from config import settings
+from circuit_breaker import CircuitBreaker
+from redis_sharding import ShardedRedis
+from logger import logger
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 
-async def get_redis() -> aioredis.Redis:
-    redis = await aioredis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+def create_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_rate=settings.REDIS_BREAKER_FAILURE_RATE,
+        slow_call_seconds=settings.REDIS_BREAKER_SLOW_CALL_MS / 1000,
+        min_calls=settings.REDIS_BREAKER_MIN_CALLS,
+        window=settings.REDIS_BREAKER_WINDOW,
+        open_seconds=settings.REDIS_BREAKER_OPEN_SECONDS,
+        half_open_probes=settings.REDIS_BREAKER_HALF_OPEN_PROBES,
+    )
+
+redis_breaker = create_breaker("redis")
+
+class CircuitBreakerPipeline(Pipeline):
+    breaker: CircuitBreaker = redis_breaker
+
+    async def execute(self, raise_on_error: bool = True):
+        return await self.breaker.call(super().execute, raise_on_error)
+
+class CircuitBreakerRedis(aioredis.Redis):
+    """Клиент Redis, все команды и конвейеры которого проходят через breaker."""
+
+    def __init__(self, *args, breaker: CircuitBreaker = redis_breaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute_command(self, *args, **options):
+        return await self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> Pipeline:
+        pipe = CircuitBreakerPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+def create_client(url: str, breaker: CircuitBreaker) -> CircuitBreakerRedis:
+    # Единый пул на воркер и инстанс. Соединения открываются по требованию; при нехватке запрос ждёт
+    # свободное соединение до REDIS_POOL_TIMEOUT секунд, а не открывает новое.
+    pool = aioredis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    return CircuitBreakerRedis(connection_pool=pool, breaker=breaker)
+
+# С REDIS_SHARD_URLS ключи приложения распределяются по шардам, у каждого свой breaker;
+# REDIS_URL тогда остаётся только для Celery (если не задан CELERY_BROKER_URL)
+if settings.REDIS_SHARD_URLS:
+    redis = ShardedRedis(
+        {url: create_client(url, create_breaker(f"redis-{i}")) for i, url in enumerate(settings.REDIS_SHARD_URLS)},
+        vnodes=settings.REDIS_SHARD_VNODES,
+    )
+else:
+    redis = create_client(settings.REDIS_URL, redis_breaker)
+
+def shard_clients(client: Union[aioredis.Redis, ShardedRedis]) -> list[aioredis.Redis]:
+    return list(client.shards.values()) if isinstance(client, ShardedRedis) else [client]
+
+async def open_redis():
+    if settings.REDIS_SHARD_URLS and (settings.CELERY_BROKER_URL or settings.REDIS_URL) in settings.REDIS_SHARD_URLS:
+        logger.warning("Celery broker shares an instance with a Redis shard; set CELERY_BROKER_URL to a separate one")
+    if settings.REDIS_BREAKER_SLOW_CALL_MS >= settings.REDIS_OPERATION_TIMEOUT * 1000:
+        logger.warning("REDIS_BREAKER_SLOW_CALL_MS is not below REDIS_OPERATION_TIMEOUT; stalled Redis calls will not open the breaker")
     try:
-        yield redis
-    finally:
-        await redis.close()
+        await redis.ping()
+    except RedisError as e:
+        # Redis не обязателен для старта: зависящие от него подсистемы деградируют сами
+        logger.warning(f"Redis is unavailable at startup: {e!r}")
+
+async def close_redis():
+    for client in shard_clients(redis):
+        await client.aclose()
+        await client.connection_pool.disconnect()
+
+async def get_redis() -> aioredis.Redis:
+    return redis
+
+async def get_many(client: aioredis.Redis, keys: list[str]) -> list[Optional[bytes]]:
+    async with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.get(key)
+        return await pipe.execute()
+
+async def set_many(client: aioredis.Redis, values: dict[str, Union[bytes, str, int]], ttl: Optional[int] = None):
+    async with client.pipeline(transaction=False) as pipe:
+        for key, value in values.items():
+            pipe.set(key, value, ex=ttl)
+        await pipe.execute()
+
+async def incrby_many(client: aioredis.Redis, increments: list[tuple[str, int, int]]) -> list[int]:
+    """INCRBY с продлением TTL для каждого (ключ, приращение, ttl в секундах); возвращает новые значения."""
+    async with client.pipeline(transaction=False) as pipe:
+        for key, amount, ttl in increments:
+            pipe.incrby(key, amount)
+            pipe.expire(key, ttl)
+        return (await pipe.execute())[::2]
+
+async def delete_many(client: aioredis.Redis, keys: list[str]) -> int:
+    return await client.delete(*keys) if keys else 0
 
 CACHE_TTL = 300
-NOTES_CACHE_PREFIX = "notes:" 
\ No newline at end of file
+NOTES_CACHE_PREFIX = "notes:"
\ No newline at end of file
@@ -0,0 +1,155 @@
+import asyncio
+import bisect
+import hashlib
+from typing import Any
+import redis.asyncio as aioredis
+from redis.commands.core import AsyncCoreCommands
+from redis.connection import Encoder
+from redis.exceptions import RedisError
+
+# Команды с несколькими ключами, которые можно разослать по шардам и сложить ответы
+SUMMED_COMMANDS = {"DEL", "UNLINK", "EXISTS", "TOUCH"}
+# Команды без ключей, которые выполняются на всех шардах; ответ берётся с первого
+BROADCAST_COMMANDS = {"PING", "SCRIPT LOAD", "SCRIPT FLUSH"}
+
+def hash_tag(key: str) -> str:
+    """Как в Redis Cluster: если в ключе есть непустой {...}, хэшируется только первое такое вхождение."""
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+def tagged(value: str) -> str:
+    """Часть ключа, по которой ключи группируются на одном шарде: ratelimit:auth:{user:alice}."""
+    return f"{{{value}}}"
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+class HashRing:
+    """
+    Консистентное хэширование с виртуальными узлами: каждый узел занимает vnodes точек на кольце,
+    ключ принадлежит ближайшей точке по часовой стрелке. При добавлении или удалении узла
+    переезжает примерно 1/N ключей, а не почти все, как при hash % N.
+    """
+
+    def __init__(self, nodes: list[str], vnodes: int):
+        self.points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def node(self, key: str) -> str:
+        index = bisect.bisect(self.hashes, _hash(hash_tag(key))) % len(self.points)
+        return self.points[index][1]
+
+def _command(args: tuple) -> str:
+    name = str(args[0]).upper()
+    if name == "SCRIPT" and len(args) > 1:
+        return f"SCRIPT {str(args[1]).upper()}"
+    return name
+
+def _key(key) -> str:
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+def _keys(args: tuple) -> list[str]:
+    name = _command(args)
+    if name in ("EVAL", "EVALSHA"):
+        return [_key(key) for key in args[3:3 + int(args[2])]]
+    if name in SUMMED_COMMANDS:
+        return [_key(key) for key in args[1:]]
+    if len(args) < 2:
+        raise RedisError(f"{name} has no key and cannot be routed to a shard")
+    return [_key(args[1])]
+
+class ShardedRedis(AsyncCoreCommands):
+    """
+    Клиент поверх нескольких независимых Redis: каждая команда уходит на шард своего ключа.
+
+    Скрипты и многоключевые команды требуют, чтобы все ключи были на одном шарде — для этого
+    в ключах используется хэш-тег (см. tagged). DEL/EXISTS/UNLINK/TOUCH с ключами разных шардов
+    выполняются на каждом шарде, результаты складываются.
+    """
+
+    def __init__(self, shards: dict[str, aioredis.Redis], vnodes: int):
+        self.shards = shards
+        self.ring = HashRing(list(shards), vnodes)
+
+    def get_encoder(self) -> Encoder:
+        return next(iter(self.shards.values())).get_encoder()
+
+    def shard(self, key: str) -> aioredis.Redis:
+        return self.shards[self.ring.node(key)]
+
+    def group(self, keys: list[str]) -> dict[str, list[str]]:
+        groups: dict[str, list[str]] = {}
+        for key in keys:
+            groups.setdefault(self.ring.node(key), []).append(key)
+        return groups
+
+    async def execute_command(self, *args, **options) -> Any:
+        name = _command(args)
+        if name in BROADCAST_COMMANDS:
+            results = await asyncio.gather(*[shard.execute_command(*args, **options) for shard in self.shards.values()])
+            return results[0]
+
+        groups = self.group(_keys(args))
+        if len(groups) == 1:
+            return await self.shards[next(iter(groups))].execute_command(*args, **options)
+        if name not in SUMMED_COMMANDS:
+            raise RedisError(f"CROSSSLOT {name} keys belong to different shards; use a hash tag")
+        results = await asyncio.gather(*[
+            self.shards[node].execute_command(args[0], *keys, **options) for node, keys in groups.items()
+        ])
+        return sum(results)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> "ShardedPipeline":
+        return ShardedPipeline(self, transaction)
+
+    async def aclose(self):
+        for shard in self.shards.values():
+            await shard.aclose()
+
+class ShardedPipeline(AsyncCoreCommands):
+    """
+    Конвейер, который при execute разбивается на конвейеры по шардам; они выполняются параллельно,
+    а ответы возвращаются в исходном порядке. Транзакция действует только в пределах шарда.
+    """
+
+    def __init__(self, client: ShardedRedis, transaction: bool):
+        self.client = client
+        self.transaction = transaction
+        self.command_stack: list[tuple[tuple, dict]] = []
+
+    async def __aenter__(self) -> "ShardedPipeline":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.command_stack = []
+
+    def execute_command(self, *args, **options) -> "ShardedPipeline":
+        self.command_stack.append((args, options))
+        return self
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        stack, self.command_stack = self.command_stack, []
+        batches: dict[str, list[int]] = {}
+        for index, (args, _) in enumerate(stack):
+            groups = self.client.group(_keys(args))
+            if len(groups) != 1:
+                raise RedisError(f"CROSSSLOT {_command(args)} keys belong to different shards; use a hash tag")
+            batches.setdefault(next(iter(groups)), []).append(index)
+
+        async def run(node: str, indexes: list[int]) -> list:
+            async with self.client.shards[node].pipeline(transaction=self.transaction) as pipe:
+                for index in indexes:
+                    args, options = stack[index]
+                    pipe.execute_command(*args, **options)
+                return await pipe.execute(raise_on_error)
+
+        results: list = [None] * len(stack)
+        batch_results = await asyncio.gather(*[run(node, indexes) for node, indexes in batches.items()])
+        for indexes, values in zip(batches.values(), batch_results):
+            for index, value in zip(indexes, values):
+                results[index] = value
+        return results
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, HTTPException, status, Depends, Path
-from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 from models import Note, NoteCreate, NoteUpdate, NoteOut, User
-from database import async_session
+from database import get_session, replicas
+from config import settings
+from write_coalescer import write_coalescer
 from auth import get_current_user
+from queries import NOTE_BY_ID_AND_OWNER, NOTES_PAGE_BY_OWNER, NOTES_SEARCH_PAGE_BY_OWNER
 
 router = APIRouter(
     prefix="/notes",
@@ -43,15 +45,22 @@ router = APIRouter(
 )
 async def create_note(
     note: NoteCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
 ):
-    async with async_session() as session:
-        new_note = Note(text=note.text, owner_id=current_user.id)
-        session.add(new_note)
-        await session.commit()
-        await session.refresh(new_note)
+    if settings.WRITE_COALESCING_ENABLED:
+        # Соединение запроса не нужно, пока запись ждёт своего пакета
+        await session.close()
+        new_note = await write_coalescer.create_note(owner_id=current_user.id, text=note.text)
+        replicas.mark_write(current_user.username)
         return new_note
 
+    new_note = Note(text=note.text, owner_id=current_user.id)
+    session.add(new_note)
+    await session.commit()
+    await session.refresh(new_note)
+    return new_note
+
 @router.get(
     "/",
     response_model=list[NoteOut],
@@ -80,19 +89,16 @@ async def read_notes(
     skip: int = 0,
     limit: int = 100,
     search: str = None,
+    session: AsyncSession = Depends(get_session)
 ):
-    async with async_session() as session:
-        query = select(Note).where(Note.owner_id == current_user.id)
-
-        if search:
-            query = query.where(Note.text.ilike(f"%{search}%"))
-
-        query = query.offset(skip).limit(limit)
+    params = {"owner_id": current_user.id, "skip": skip, "limit": limit}
+    if search:
+        result = await session.execute(NOTES_SEARCH_PAGE_BY_OWNER, {**params, "pattern": f"%{search}%"})
+    else:
+        result = await session.execute(NOTES_PAGE_BY_OWNER, params)
+    notes = result.scalars().all()
 
-        result = await session.execute(query)
-        notes = result.scalars().all()
-
-        return notes
+    return notes
 
 @router.get(
     "/{note_id}",
@@ -116,13 +122,14 @@ async def read_notes(
 )
 async def read_note(
     note_id: int = Path(..., ge=1, description="ID заметки"),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
 ):
-    async with async_session() as session:
-        note = await session.get(Note, note_id)
-        if not note or note.owner_id != current_user.id:
-            raise HTTPException(status_code=404, detail="Note not found")
-        return note
+    result = await session.execute(NOTE_BY_ID_AND_OWNER, {"note_id": note_id, "owner_id": current_user.id})
+    note = result.scalar_one_or_none()
+    if not note:
+        raise HTTPException(status_code=404, detail="Note not found")
+    return note
 
 @router.put(
     "/{note_id}",
@@ -147,20 +154,29 @@ async def read_note(
 async def update_note(
     note_id: int = Path(..., ge=1, description="ID заметки"),
     note_update: NoteUpdate = None,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
 ):
-    async with async_session() as session:
-        note = await session.get(Note, note_id)
-        if not note or note.owner_id != current_user.id:
+    if settings.WRITE_COALESCING_ENABLED and note_update.text is not None:
+        await session.close()
+        note = await write_coalescer.update_note(note_id, current_user.id, note_update.text)
+        if not note:
             raise HTTPException(status_code=404, detail="Note not found")
+        replicas.mark_write(current_user.username)
+        return note
 
-        if note_update.text is not None:
-            note.text = note_update.text
+    result = await session.execute(NOTE_BY_ID_AND_OWNER, {"note_id": note_id, "owner_id": current_user.id})
+    note = result.scalar_one_or_none()
+    if not note:
+        raise HTTPException(status_code=404, detail="Note not found")
 
-        session.add(note)
-        await session.commit()
-        await session.refresh(note)
-        return note
+    if note_update.text is not None:
+        note.text = note_update.text
+
+    session.add(note)
+    await session.commit()
+    await session.refresh(note)
+    return note
 
 @router.delete(
     "/{note_id}",
@@ -183,13 +199,14 @@ async def update_note(
 )
 async def delete_note(
     note_id: int = Path(..., ge=1, description="ID заметки"),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
 ):
-    async with async_session() as session:
-        note = await session.get(Note, note_id)
-        if not note or note.owner_id != current_user.id:
-            raise HTTPException(status_code=404, detail="Note not found")
+    result = await session.execute(NOTE_BY_ID_AND_OWNER, {"note_id": note_id, "owner_id": current_user.id})
+    note = result.scalar_one_or_none()
+    if not note:
+        raise HTTPException(status_code=404, detail="Note not found")
 
-        await session.delete(note)
-        await session.commit()
-        return None
\ No newline at end of file
+    await session.delete(note)
+    await session.commit()
+    return None
\ No newline at end of file
@@ -1,10 +1,12 @@
 from celery import Celery
 import time
+from config import settings
 
+# Celery работает со своими (синхронными) соединениями, поэтому общий пул приложения ему не подходит
 celery_app = Celery(
     "tasks",
-    broker="redis://redis:6379/0",
-    backend="redis://redis:6379/0"
+    broker=settings.CELERY_BROKER_URL or settings.REDIS_URL,
+    backend=settings.CELERY_RESULT_BACKEND or settings.CELERY_BROKER_URL or settings.REDIS_URL
 )
 
 @celery_app.task(
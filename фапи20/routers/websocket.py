@@ -1,5 +1,7 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from websocket_manager import ConnectionManager
+from broadcast import create_broadcast
+from redis_config import redis
 
 router = APIRouter(
     tags=["WebSocket"],
@@ -16,6 +18,7 @@ router = APIRouter(
 )
 
 manager = ConnectionManager()
+broadcaster = create_broadcast(manager, redis)
 
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -24,11 +27,11 @@ async def websocket_endpoint(websocket: WebSocket):
     
     Поддерживает подключение нескольких клиентов и широковещательную рассылку сообщений.
     """
-    await manager.connect(websocket)
+    connection = await manager.connect(websocket)
     try:
         while True:
             data = await websocket.receive_text()
-            await manager.broadcast(f"Сообщение: {data}")
+            broadcaster.publish(f"Сообщение: {data}")
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        await manager.broadcast("Клиент отключился") 
\ No newline at end of file
+        manager.disconnect(connection)
+        broadcaster.publish("Клиент отключился") 
\ No newline at end of file
@@ -0,0 +1,38 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+from fastapi.responses import JSONResponse
+
+@dataclass
+class RequestTimings:
+    durations: dict[str, float] = field(default_factory=dict)
+    expose: bool = False  # отдавать ли разбивку клиенту в заголовке Server-Timing
+
+    def add(self, component: str, seconds: float):
+        self.durations[component] = self.durations.get(component, 0.0) + seconds
+
+    def header(self) -> str:
+        return ", ".join(f"{component};dur={seconds * 1000:.2f}" for component, seconds in self.durations.items())
+
+# Время по компонентам (jwt, auth_db, db, ratelimit, serialize) в рамках текущего HTTP-запроса
+request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+def record(component: str, seconds: float):
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(component, seconds)
+
+@contextmanager
+def timed(component: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(component, time.perf_counter() - start)
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with timed("serialize"):
+            return super().render(content)
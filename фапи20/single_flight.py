@@ -0,0 +1,127 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, Optional
+from urllib.parse import parse_qsl, urlencode
+from uuid import uuid4
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from starlette.types import Message, Scope
+from logger import logger
+from redis_sharding import tagged
+
+Messages = list[Message]
+
+# Чтения, которые можно объединять: ответ зависит только от пользователя, пути и параметров запроса
+SINGLE_FLIGHT_ROUTES = {"/notes/", "/notes/{note_id}", "/users/me"}
+
+def request_key(identity: str, scope: Scope) -> str:
+    query = urlencode(sorted(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)))
+    return f"{identity}|{scope['path']}?{query}"
+
+def dump_messages(messages: Messages) -> dict[str, bytes]:
+    start = messages[0]
+    headers = [[name.decode("latin-1"), value.decode("latin-1")] for name, value in start.get("headers", [])]
+    return {
+        "status": str(start["status"]).encode(),
+        "headers": json.dumps(headers).encode(),
+        "body": b"".join(message.get("body", b"") for message in messages[1:]),
+    }
+
+def load_messages(data: dict[bytes, bytes]) -> Messages:
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(data[b"headers"])]
+    return [
+        {"type": "http.response.start", "status": int(data[b"status"]), "headers": headers},
+        {"type": "http.response.body", "body": data[b"body"], "more_body": False},
+    ]
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных чтений: пока ответ на ключ вычисляется, остальные
+    запросы с тем же ключом ждут его и получают те же байты.
+
+    С redis объединение работает и между воркерами: лидер берёт блокировку SET NX, а воркеры, которым
+    она не досталась, ждут его ответ в Redis. Ответ хранится под токеном блокировки и нужен только тем,
+    кто застал её, так что после завершения лидера новые запросы выполняются заново.
+    """
+
+    def __init__(self, redis: Optional[Redis], prefix: str, lock_ttl: float, poll_interval: float):
+        self.redis = redis
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.inflight: dict[str, asyncio.Future] = {}
+
+    async def run(self, key: str, execute: Callable[[], Awaitable[Messages]]) -> tuple[Messages, bool]:
+        """Возвращает ответ и признак того, что он получен от чужого выполнения."""
+        future = self.inflight.get(key)
+        if future is not None:
+            messages = await asyncio.shield(future)
+            if messages is not None:
+                return messages, True
+            return await execute(), False
+
+        future = self.inflight[key] = asyncio.get_running_loop().create_future()
+        messages = None
+        try:
+            if self.redis is not None:
+                messages, shared = await self._run_shared(key, execute)
+                return messages, shared
+            messages = await execute()
+            return messages, False
+        finally:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+            # None — лидер не справился: ожидающие выполнят запрос сами
+            future.set_result(messages)
+
+    def invalidate(self, identity: str):
+        """После записи новые чтения пользователя не должны присоединяться к начатым до неё."""
+        for key in [key for key in self.inflight if key.startswith(f"{identity}|")]:
+            del self.inflight[key]
+
+    async def _run_shared(self, key: str, execute: Callable[[], Awaitable[Messages]]) -> tuple[Messages, bool]:
+        lock_key = f"{self.prefix}lock:{tagged(key)}"
+        token = uuid4().hex
+        try:
+            acquired = await self.redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+            leader = None if acquired else await self.redis.get(lock_key)
+        except RedisError as e:
+            logger.warning(f"Single-flight lock unavailable, executing locally: {e!r}")
+            return await execute(), False
+
+        if acquired:
+            try:
+                messages = await execute()
+            except BaseException:
+                # Ожидающие в других воркерах увидят, что блокировки нет, и выполнят запрос сами, не дожидаясь lock_ttl
+                try:
+                    await self.redis.delete(lock_key)
+                except RedisError:
+                    pass
+                raise
+            result_key = f"{self.prefix}result:{tagged(key)}:{token}"
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.hset(result_key, mapping=dump_messages(messages))
+                    pipe.pexpire(result_key, int(self.lock_ttl * 1000))
+                    pipe.delete(lock_key)
+                    await pipe.execute()
+            except RedisError as e:
+                logger.warning(f"Single-flight result not published: {e!r}")
+            return messages, False
+
+        if leader is not None:
+            result_key = f"{self.prefix}result:{tagged(key)}:{leader.decode()}"
+            deadline = time.monotonic() + self.lock_ttl
+            try:
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(self.poll_interval)
+                    data = await self.redis.hgetall(result_key)
+                    if data:
+                        return load_messages(data), True
+                    if not await self.redis.exists(lock_key):
+                        break
+            except RedisError as e:
+                logger.warning(f"Single-flight wait failed, executing locally: {e!r}")
+        return await execute(), False
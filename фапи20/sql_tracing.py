@@ -0,0 +1,81 @@
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from config import settings
+from logger import logger
+from server_timing import record
+from metrics import (
+    DB_CONNECTIONS_PER_REQUEST, DB_STATEMENTS_PER_REQUEST, DB_TIME_PER_REQUEST,
+    DB_SLOW_STATEMENTS, DB_N_PLUS_ONE_REQUESTS,
+)
+
+@dataclass
+class RequestDbStats:
+    route: str = "unmatched"
+    checkouts: int = 0
+    statements: int = 0
+    db_time: float = 0.0
+    statement_counts: Counter = field(default_factory=Counter)
+
+# Статистика обращений к БД в рамках текущего HTTP-запроса
+request_db_stats: ContextVar[Optional[RequestDbStats]] = ContextVar("request_db_stats", default=None)
+
+def redact_parameters(parameters) -> str:
+    """Заменяет значения параметров их типами, чтобы в лог не попадали пароли и тексты заметок."""
+    if isinstance(parameters, dict):
+        return str({key: type(value).__name__ for key, value in parameters.items()})
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (list, tuple, dict)):
+            return f"<{len(parameters)} parameter sets>"
+        return str([type(value).__name__ for value in parameters])
+    return "<redacted>"
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "query_start", None)
+    if start is None:
+        return
+    duration = time.perf_counter() - start
+    record("db", duration)
+    stats = request_db_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += duration
+        stats.statement_counts[statement] += 1
+    if duration * 1000 >= settings.DB_SLOW_QUERY_THRESHOLD_MS:
+        route = stats.route if stats is not None else "background"
+        DB_SLOW_STATEMENTS.labels(route=route).inc()
+        logger.warning(
+            "Slow SQL statement",
+            extra={
+                "route": route,
+                "duration_ms": round(duration * 1000, 2),
+                "statement": statement,
+                "parameters": redact_parameters(parameters),
+            },
+        )
+
+def instrument_engine(engine: AsyncEngine):
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+
+def observe_request(stats: RequestDbStats):
+    DB_CONNECTIONS_PER_REQUEST.labels(route=stats.route).observe(stats.checkouts)
+    DB_STATEMENTS_PER_REQUEST.labels(route=stats.route).observe(stats.statements)
+    DB_TIME_PER_REQUEST.labels(route=stats.route).observe(stats.db_time)
+    if not stats.statement_counts:
+        return
+    statement, count = stats.statement_counts.most_common(1)[0]
+    if count > settings.DB_N_PLUS_ONE_THRESHOLD:
+        DB_N_PLUS_ONE_REQUESTS.labels(route=stats.route).inc()
+        logger.warning(
+            "Possible N+1 query pattern",
+            extra={"route": stats.route, "repeats": count, "statement": statement},
+        )
@@ -0,0 +1,119 @@
+import asyncio
+import fcntl
+import os
+import time
+from contextlib import asynccontextmanager
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from auth import get_password_hash
+from config import settings
+from database import engine, SQLITE_MODE
+from logger import logger
+from metrics import APP_STARTUP_SECONDS
+from models import User
+
+IMPORTED_AT = time.perf_counter()
+
+# Ключ advisory-блокировки, под которой один процесс в кластере выполняет миграции
+STARTUP_LOCK_ID = 7_242_019_031
+
+# Ревизия, соответствующая схеме, которую раньше создавал metadata.create_all
+LEGACY_SCHEMA_REVISION = "e493375076d0"
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+startup_role = "follower"
+
+def alembic_config() -> Config:
+    cfg = Config(os.path.join(BASE_DIR, "alembic.ini"))
+    cfg.set_main_option("script_location", os.path.join(BASE_DIR, "alembic"))
+    cfg.set_main_option("sqlalchemy.url", settings.DATABASE_URL.replace("%", "%%"))
+    cfg.attributes["configure_logger"] = False
+    return cfg
+
+def read_schema_state(sync_conn) -> tuple[str | None, bool, bool]:
+    revision = MigrationContext.configure(sync_conn).get_current_revision()
+    has_tables = inspect(sync_conn).has_table(User.__tablename__)
+    has_admin = has_tables and sync_conn.execute(
+        select(User.id).where(User.username == settings.ADMIN_USERNAME)
+    ).first() is not None
+    return revision, has_tables, has_admin
+
+@asynccontextmanager
+async def cluster_lock(conn):
+    """
+    Блокировка, под которой один процесс выполняет миграции: advisory-блокировка PostgreSQL
+    или, во встроенном режиме SQLite, flock на файле рядом с базой.
+    """
+    if SQLITE_MODE:
+        lock_path = f"{make_url(settings.DATABASE_URL).database}.startup.lock"
+        with open(lock_path, "w") as lock_file:
+            await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+
+    await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": STARTUP_LOCK_ID})
+    await conn.commit()
+    try:
+        yield
+    finally:
+        await conn.rollback()
+        await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": STARTUP_LOCK_ID})
+        await conn.commit()
+
+async def bootstrap_admin(conn):
+    hashed_password = await asyncio.to_thread(get_password_hash, settings.ADMIN_PASSWORD)
+    insert = sqlite.insert if SQLITE_MODE else postgresql.insert
+    statement = insert(User).values(
+        username=settings.ADMIN_USERNAME,
+        hashed_password=hashed_password,
+        role="admin",
+    ).on_conflict_do_nothing(index_elements=[User.username])
+    result = await conn.execute(statement)
+    await conn.commit()
+    if result.rowcount:
+        logger.info("Admin user created successfully")
+
+async def coordinate_startup():
+    """
+    Готовит схему БД и администратора один раз на весь кластер.
+
+    Если схема уже на head и администратор существует, процесс сразу начинает обслуживать
+    запросы. Иначе он берёт блокировку (cluster_lock), повторно проверяет состояние и выполняет
+    `alembic upgrade head` и создание администратора; остальные процессы ждут на блокировке.
+    """
+    global startup_role
+    cfg = alembic_config()
+    head = ScriptDirectory.from_config(cfg).get_current_head()
+
+    async with engine.connect() as conn:
+        revision, has_tables, has_admin = await conn.run_sync(read_schema_state)
+        await conn.commit()
+        if revision == head and has_admin:
+            return
+
+        async with cluster_lock(conn):
+            revision, has_tables, has_admin = await conn.run_sync(read_schema_state)
+            await conn.commit()
+            if revision != head:
+                startup_role = "leader"
+                if revision is None and has_tables:
+                    await asyncio.to_thread(command.stamp, cfg, LEGACY_SCHEMA_REVISION)
+                await asyncio.to_thread(command.upgrade, cfg, "head")
+                logger.info(f"Database migrated to revision {head}")
+            if not has_admin:
+                startup_role = "leader"
+                await bootstrap_admin(conn)
+
+def mark_ready():
+    elapsed = time.perf_counter() - IMPORTED_AT
+    APP_STARTUP_SECONDS.labels(role=startup_role).set(elapsed)
+    logger.info("Application started", extra={"startup_role": startup_role, "startup_seconds": round(elapsed, 3)})
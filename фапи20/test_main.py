@@ -1,3 +1,7 @@
+import asyncio
+import logging
+import queue
+import time
 import pytest
 import pytest_asyncio
 from httpx import AsyncClient
@@ -5,10 +9,32 @@ from httpx import ASGITransport
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import SQLModel
 from main import app
-from database import async_session, engine
+from fastapi import FastAPI
+from middleware import ConcurrencyLimitMiddleware
+from database import async_session, engine, ReplicaSet
+from config import settings
 from models import User
-from auth import get_password_hash, create_access_token
+from auth import get_password_hash, create_access_token, get_user_by_username
 from asgi_lifespan import LifespanManager
+from prometheus_client import REGISTRY
+from sql_tracing import redact_parameters
+from write_coalescer import WriteCoalescer
+from logger import BoundedQueueHandler
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from redis.exceptions import ConnectionError as RedisConnectionError
+import rate_limiter
+from rate_limiter import RedisRateLimiter, LocalRateLimiter, InProcessRateLimiter, RouteRule, RateLimitPolicy, rate_limit_identity
+from ipaddress import ip_network
+from starlette.requests import Request
+from redis.asyncio import Redis
+from near_cache import NearCache
+from redis_sharding import HashRing, ShardedRedis
+from redis_config import CircuitBreakerRedis, get_many, set_many, delete_many
+from websocket_manager import ConnectionManager
+from broadcast import RedisBroadcast
+from idempotency import IdempotencyStore, IdempotencyRequestInProgress
+from single_flight import SingleFlight
 
 @pytest_asyncio.fixture(scope="module")
 async def client():
@@ -22,6 +48,13 @@ async def client():
         session.add(test_user)
         await session.commit()
 
+    # Бакеты лимитера хранятся в Redis между прогонами: без очистки повторный запуск упирается в AUTH_POLICY
+    redis = Redis.from_url(settings.REDIS_URL)
+    keys = [key async for key in redis.scan_iter(f"{settings.RATE_LIMIT_PREFIX}*")]
+    if keys:
+        await redis.delete(*keys)
+    await redis.aclose()
+
     async with LifespanManager(app):
         transport = ASGITransport(app=app)
         async with AsyncClient(base_url="http://test", transport=transport) as c:
@@ -75,3 +108,501 @@ async def test_notes_crud(client):
 
     res_del_fail = await client.delete(f"/notes/{note_id}", headers=headers)
     assert res_del_fail.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_single_connection_per_request(client):
+    token = create_access_token({"sub": "testuser"})
+    headers = {"Authorization": f"Bearer {token}"}
+
+    res_create = await client.post("/notes/", json={"text": "pool note"}, headers=headers)
+    note_id = res_create.json()["id"]
+
+    labels = {"route": "/notes/{note_id}"}
+    before = REGISTRY.get_sample_value("db_connections_per_request_sum", labels) or 0
+    res = await client.get(f"/notes/{note_id}", headers=headers)
+    assert res.status_code == 200
+    assert REGISTRY.get_sample_value("db_connections_per_request_sum", labels) - before == 1
+
+@pytest.mark.asyncio
+async def test_request_deadline(client):
+    token = create_access_token({"sub": "testuser"})
+    headers = {"Authorization": f"Bearer {token}", "X-Request-Timeout": "0"}
+
+    labels = {"route": "/notes/"}
+    before = REGISTRY.get_sample_value("request_deadline_exceeded_total", labels) or 0
+    res = await client.get("/notes/", headers=headers)
+    assert res.status_code == 504
+    assert REGISTRY.get_sample_value("request_deadline_exceeded_total", labels) - before == 1
+
+    # Неизвестные пути не порождают отдельных серий
+    before = REGISTRY.get_sample_value("request_deadline_exceeded_total", {"route": "unmatched"}) or 0
+    for i in range(3):
+        await client.get(f"/random-{i}", headers=headers)
+    assert REGISTRY.get_sample_value("request_deadline_exceeded_total", {"route": "unmatched"}) - before == 3
+    assert REGISTRY.get_sample_value("request_deadline_exceeded_total", {"route": "/random-0"}) is None
+
+@pytest.mark.asyncio
+async def test_rate_limiter(client):
+    res = await client.get("/health")
+    assert res.headers["X-RateLimit-Limit"] == str(settings.RATE_LIMIT_REQUESTS)
+
+    redis = Redis.from_url(settings.REDIS_URL)
+    keys = ["test_ratelimit:tiny:{client}", "test_ratelimit:default:{client}"]
+    await redis.delete(*keys)
+    limiter = RedisRateLimiter(redis, prefix="test_ratelimit:")
+    rule = RouteRule(cost=5, policies=(RateLimitPolicy("tiny", capacity=2, window=60),))
+    first, second, third = [await limiter.hit("client", rule) for _ in range(3)]
+    assert (first.allowed, second.allowed, third.allowed) == (True, True, False)
+    assert (third.limit, third.remaining) == (2, 0)
+    assert 0 < third.retry_after <= 30
+    assert int(third.headers()["Retry-After"]) >= 1
+
+    # Отклонённый запрос не списывает токены из остальных бакетов
+    assert (await limiter.hit("client")).remaining == settings.RATE_LIMIT_REQUESTS - 11
+    await redis.delete(*keys)
+    await redis.aclose()
+
+@pytest.mark.asyncio
+async def test_local_rate_limiter():
+    redis = Redis.from_url(settings.REDIS_URL)
+    limiter = LocalRateLimiter(redis, prefix="test_local:", sync_interval=60, lease=2, operation_timeout=1)
+    rule = RouteRule(policies=(RateLimitPolicy("tiny", capacity=3, window=86400),))
+    results = [await limiter.hit("client", rule) for _ in range(4)]
+    assert [r.allowed for r in results] == [True, True, True, False]
+    assert results[-1].retry_after > 0
+
+    await limiter.close()
+    window = int(time.time() // 86400)
+    assert int(await redis.get(f"test_local:tiny:{{client}}:{window}")) == 3
+    await redis.delete(f"test_local:tiny:{{client}}:{window}")
+    await redis.aclose()
+
+    # Недоступный Redis при остановке не прерывает shutdown
+    down = Redis.from_url("redis://127.0.0.1:1", socket_connect_timeout=0.1)
+    limiter = LocalRateLimiter(down, prefix="test_local:", sync_interval=60, lease=2, operation_timeout=1)
+    await limiter.hit("client", rule)
+    await limiter.close()
+    await down.aclose()
+
+    # Локальный запас выдаётся без Redis; ожидание сверки с зависшим Redis ограничено operation_timeout
+    stalled = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+    hung = Redis(host="127.0.0.1", port=stalled.sockets[0].getsockname()[1])
+    limiter = LocalRateLimiter(hung, prefix="test_local:", sync_interval=60, lease=2, operation_timeout=0.05)
+    assert (await limiter.hit("client", rule)).allowed and (await limiter.hit("client", rule)).allowed
+    start = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        await limiter.hit("client", rule)
+    assert time.monotonic() - start < 0.5
+    limiter._sync.cancel()
+    await hung.aclose()
+    stalled.close()
+
+def test_rate_limit_identity(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "TRUSTED_PROXIES", [ip_network("10.0.0.0/8")])
+
+    def request(peer, headers=()):
+        return Request({"type": "http", "client": (peer, 1234), "headers": [(k.encode(), v.encode()) for k, v in headers]})
+
+    forwarded = [("x-forwarded-for", "6.6.6.6, 1.2.3.4, 10.0.0.2")]
+    assert rate_limiter.client_ip(request("10.0.0.1", forwarded)) == "1.2.3.4"
+    assert rate_limiter.client_ip(request("5.5.5.5", forwarded)) == "5.5.5.5"
+
+    token = create_access_token({"sub": "testuser"})
+    assert rate_limit_identity(request("10.0.0.1", [("authorization", f"Bearer {token}")])) == "user:testuser"
+    assert rate_limit_identity(request("5.5.5.5", [("authorization", "Bearer forged")])) == "ip:5.5.5.5"
+
+@pytest.mark.asyncio
+async def test_server_timing(client):
+    user_headers = {"Authorization": f"Bearer {create_access_token({'sub': 'testuser'})}"}
+    res = await client.get("/users/me", headers=user_headers)
+    assert res.status_code == 200
+    assert "Server-Timing" not in res.headers
+
+    admin_headers = {"Authorization": f"Bearer {create_access_token({'sub': settings.ADMIN_USERNAME})}"}
+    res = await client.get("/users/me", headers=admin_headers)
+    assert res.status_code == 200
+    components = {entry.split(";")[0].strip() for entry in res.headers["Server-Timing"].split(",")}
+    assert {"ratelimit", "jwt", "auth_db", "db", "serialize", "total"} <= components
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    breaker = CircuitBreaker(
+        "test", failure_rate=0.5, slow_call_seconds=1, min_calls=2, window=60, open_seconds=60, half_open_probes=1
+    )
+
+    async def fail():
+        raise RedisConnectionError("down")
+
+    async def ok():
+        return "ok"
+
+    for _ in range(2):
+        with pytest.raises(RedisConnectionError):
+            await breaker.call(fail)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        await breaker.call(ok)
+
+    breaker.open_seconds = 0
+    assert await breaker.call(ok) == "ok"
+    assert breaker.state == "closed"
+
+    # Отмена по таймауту вызывающего не считается неудачей Redis и не занимает пробный слот
+    async def hang():
+        await asyncio.sleep(1)
+
+    for _ in range(5):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(breaker.call(hang), 0.001)
+    assert breaker.state == "closed" and not breaker.calls
+    breaker._open()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(breaker.call(hang), 0.001)
+    assert breaker.state == "half_open" and breaker.probes_in_flight == 0
+
+    # Счётчик неудач следует за окном: вытесненные вызовы из него вычитаются
+    windowed = CircuitBreaker(
+        "window", failure_rate=0.5, slow_call_seconds=1, min_calls=10, window=0.05, open_seconds=60, half_open_probes=1
+    )
+    for _ in range(3):
+        windowed.record(True, probe=False)
+    assert windowed.failures == 3
+    await asyncio.sleep(0.06)
+    windowed.record(False, probe=False)
+    assert windowed.failures == 0 and len(windowed.calls) == 1
+
+    limiter = InProcessRateLimiter()
+    rule = RouteRule(policies=(RateLimitPolicy("tiny", capacity=1, window=60),))
+    assert (await limiter.hit("client", rule)).allowed
+    assert not (await limiter.hit("client", rule)).allowed
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens_on_stalled_redis():
+    # Сервер принимает соединения и молчит: каждый вызов отменяется по таймауту вызывающего
+    stalled = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+    port = stalled.sockets[0].getsockname()[1]
+    breaker = CircuitBreaker(
+        "stalled", failure_rate=0.5, slow_call_seconds=0.02, min_calls=5, window=60, open_seconds=60, half_open_probes=1
+    )
+    client = CircuitBreakerRedis(host="127.0.0.1", port=port, breaker=breaker)
+    try:
+        for _ in range(5):
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.get("key"), 0.05)
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await client.get("key")
+    finally:
+        await client.aclose()
+        stalled.close()
+
+@pytest.mark.asyncio
+async def test_adaptive_concurrency_limiter():
+    limiter = AdaptiveConcurrencyLimiter(
+        initial_limit=2, min_limit=1, max_limit=10, target_latency=0.1, backoff=0.5, queue_size=1, max_queue_time=0.05
+    )
+    assert await limiter.acquire("high") and await limiter.acquire("high")
+    assert not await limiter.acquire("low")
+    assert await limiter.acquire("critical")
+    limiter.release(0.01, failed=False)
+
+    waiting = asyncio.create_task(limiter.acquire("high"))
+    await asyncio.sleep(0)
+    assert not await limiter.acquire("normal")  # очередь заполнена
+    limiter.release(0.01, failed=False)
+    assert await waiting
+
+    assert not await limiter.acquire("high")  # слот не освободился за max_queue_time
+    limiter.release(1.0, failed=False)
+    assert limiter.limit < 2
+
+@pytest.mark.asyncio
+async def test_request_priority_requires_valid_token():
+    class RecordingLimiter:
+        def __init__(self):
+            self.priorities = []
+
+        async def acquire(self, priority):
+            self.priorities.append(priority)
+            return True
+
+        def release(self, latency, failed):
+            pass
+
+    limiter = RecordingLimiter()
+    probe = FastAPI()
+    probe.post("/notes/")(lambda: {})
+    probe.add_middleware(ConcurrencyLimitMiddleware, limiter=limiter)
+    token = create_access_token({"sub": "testuser"})
+    async with AsyncClient(base_url="http://test", transport=ASGITransport(app=probe)) as c:
+        await c.post("/notes/", headers={"Authorization": "x"})
+        await c.post("/notes/", headers={"Authorization": f"Bearer {token}"})
+    assert limiter.priorities == ["normal", "high"]
+
+def test_log_queue_overflow():
+    handler = BoundedQueueHandler(queue.Queue(maxsize=1))
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "message %s", ("arg",), None)
+    before = REGISTRY.get_sample_value("log_records_dropped_total")
+    handler.handle(record)
+    handler.handle(record)
+    assert REGISTRY.get_sample_value("log_records_dropped_total") - before == 1
+    assert handler.queue.get_nowait().msg == "message arg"
+
+@pytest.mark.asyncio
+async def test_single_flight(client):
+    token = create_access_token({"sub": "testuser"})
+    headers = {"Authorization": f"Bearer {token}"}
+    note_id = (await client.post("/notes/", json={"text": "shared read"}, headers=headers)).json()["id"]
+
+    labels = {"route": "/notes/{note_id}", "outcome": "shared"}
+    before = REGISTRY.get_sample_value("single_flight_requests_total", labels) or 0
+    responses = await asyncio.gather(*[client.get(f"/notes/{note_id}", headers=headers) for _ in range(5)])
+    assert {res.status_code for res in responses} == {200}
+    assert {res.json()["text"] for res in responses} == {"shared read"}
+    assert all(len(res.headers.get_list("X-RateLimit-Limit")) == 1 for res in responses)
+    assert REGISTRY.get_sample_value("single_flight_requests_total", labels) - before >= 1
+
+@pytest.mark.asyncio
+async def test_rejected_request_access_log(client, caplog):
+    token = create_access_token({"sub": "testuser"})
+    with caplog.at_level(logging.INFO):
+        res = await client.get("/notes/", headers={"Authorization": f"Bearer {token}", "X-Request-Timeout": "0"})
+    assert res.status_code == 504
+    records = [record for record in caplog.records if getattr(record, "status", None) == 504]
+    assert records and records[0].route == "/notes/" and records[0].levelname == "ERROR"
+
+@pytest.mark.asyncio
+async def test_idempotency_key(client):
+    token = create_access_token({"sub": "testuser"})
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": f"test-{time.time_ns()}"}
+
+    responses = await asyncio.gather(*[client.post("/notes/", json={"text": "once"}, headers=headers) for _ in range(3)])
+    assert {res.status_code for res in responses} == {201}
+    assert len({res.json()["id"] for res in responses}) == 1
+    assert sum(res.headers.get("Idempotent-Replayed") == "true" for res in responses) == 2
+
+    res = await client.post("/notes/", json={"text": "other"}, headers=headers)
+    assert res.status_code == 422
+
+@pytest.mark.asyncio
+async def test_single_flight_leader_failure():
+    redis = Redis.from_url(settings.REDIS_URL)
+    # Два экземпляра — как два воркера: ожидающий видит лидера только через Redis
+    leader, follower = (SingleFlight(redis, prefix="test:singleflight:", lock_ttl=5, poll_interval=0.01) for _ in range(2))
+    key = f"failing-{time.time_ns()}"
+    response = [{"type": "http.response.start", "status": 200, "headers": []}, {"type": "http.response.body", "body": b"ok"}]
+
+    async def fail():
+        await asyncio.sleep(0.1)
+        raise RuntimeError("handler failed")
+
+    async def ok():
+        return response
+
+    failing = asyncio.create_task(leader.run(key, fail))
+    await asyncio.sleep(0.02)
+    start = time.monotonic()
+    assert await follower.run(key, ok) == (response, False)
+    assert time.monotonic() - start < 1
+    with pytest.raises(RuntimeError):
+        await failing
+    await redis.aclose()
+
+@pytest.mark.asyncio
+async def test_idempotency_lock_outlives_ttl():
+    redis = Redis.from_url(settings.REDIS_URL)
+    store = IdempotencyStore(redis, prefix="test:idempotency:", ttl=60, lock_ttl=0.2, poll_interval=0.01)
+    key = f"slow-{time.time_ns()}"
+    runs = 0
+
+    async def slow():
+        nonlocal runs
+        runs += 1
+        await asyncio.sleep(0.5)
+        return [{"type": "http.response.start", "status": 201, "headers": []}, {"type": "http.response.body", "body": b"ok"}]
+
+    # Обработчик дольше lock_ttl: повтор не выполняет его сам, а получает отказ, пока первый не завершится
+    first = asyncio.create_task(store.run(key, b"fp", slow))
+    await asyncio.sleep(0.05)
+    with pytest.raises(IdempotencyRequestInProgress):
+        await store.run(key, b"fp", slow)
+    assert (await first)[1] is False
+    messages, replayed = await store.run(key, b"fp", slow)
+    assert replayed and messages[1]["body"] == b"ok" and runs == 1
+    await redis.aclose()
+
+@pytest.mark.asyncio
+async def test_near_cache():
+    redis = Redis.from_url(settings.REDIS_URL)
+    key = f"{rate_limiter.POLICY_OVERRIDE_PREFIX}test-tiny"
+    await redis.delete(key)
+    cache = NearCache(redis, prefixes=[rate_limiter.POLICY_OVERRIDE_PREFIX], max_entries=100, ping_interval=1)
+    cache.start()
+    while not cache.tracking:
+        await asyncio.sleep(0.01)
+
+    await redis.hset(key, mapping={"capacity": 2, "window": 60})
+    rule = await rate_limiter.apply_policy_overrides(RouteRule(policies=(RateLimitPolicy("test-tiny", 10, 1),)), cache)
+    assert rule.policies[0] == RateLimitPolicy("test-tiny", 2, 60.0)
+    assert await cache.hgetall(key) == {b"capacity": b"2", b"window": b"60"}
+    assert key in cache.entries
+
+    # Изменение ключа другим клиентом вытесняет его из кэша
+    await redis.hset(key, "capacity", 3)
+    for _ in range(100):
+        if key not in cache.entries:
+            break
+        await asyncio.sleep(0.01)
+    assert (await cache.hgetall(key))[b"capacity"] == b"3"
+
+    await cache.close()
+    assert not cache.tracking and not cache.entries
+    await redis.delete(key)
+    await redis.aclose()
+
+def test_hash_ring():
+    keys = [f"key:{i}" for i in range(1000)]
+    ring = HashRing(["a", "b", "c"], vnodes=160)
+    owners = [ring.node(key) for key in keys]
+    assert all(owners.count(node) > 200 for node in "abc")
+
+    # Новый узел забирает примерно четверть ключей, остальные остаются на месте
+    grown = HashRing(["a", "b", "c", "d"], vnodes=160)
+    moved = [key for key, owner in zip(keys, owners) if grown.node(key) != owner]
+    assert 150 < len(moved) < 350
+    assert all(grown.node(key) == "d" for key in moved)
+
+    assert ring.node("ratelimit:auth:{user:alice}") == ring.node("ratelimit:default:{user:alice}:123")
+
+@pytest.mark.asyncio
+async def test_sharded_redis():
+    client = ShardedRedis({f"db{db}": Redis.from_url(settings.REDIS_URL, db=db) for db in (1, 2, 3)}, vnodes=160)
+    keys = [f"test_shard:{i}" for i in range(300)]
+    assert len(client.group(keys)) == 3
+
+    await set_many(client, {key: key for key in keys})
+    assert await get_many(client, keys) == [key.encode() for key in keys]
+    assert all([await client.shard(key).get(key) == key.encode() for key in keys[:10]])
+    assert await delete_many(client, keys) == 300
+
+    # Скрипт с несколькими ключами работает, потому что бакеты клиента помечены одним хэш-тегом
+    limiter = RedisRateLimiter(client, prefix="test_shard:")
+    rule = RouteRule(policies=(RateLimitPolicy("tiny", capacity=1, window=60),))
+    assert [(await limiter.hit("user:alice", rule)).allowed for _ in range(2)] == [True, False]
+    assert await client.delete("test_shard:default:{user:alice}", "test_shard:tiny:{user:alice}") == 2
+    await client.aclose()
+
+class FakeWebSocket:
+    def __init__(self, delay: float = 0, broken: bool = False):
+        self.delay = delay
+        self.broken = broken
+        self.received: list[str] = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self.broken:
+            raise RuntimeError("connection lost")
+        await asyncio.sleep(self.delay)
+        self.received.append(message)
+
+    async def close(self, code: int):
+        self.close_code = code
+
+@pytest.mark.asyncio
+async def test_websocket_broadcast():
+    manager = ConnectionManager(queue_size=2, overflow_policy="drop_oldest", send_timeout=1)
+    fast, slow, broken = FakeWebSocket(), FakeWebSocket(delay=0.2), FakeWebSocket(broken=True)
+    connections = [await manager.connect(websocket) for websocket in (fast, slow, broken)]
+
+    # Рассылка не ждёт медленного клиента, а сломанный не мешает остальным
+    for i in range(5):
+        manager.broadcast(str(i))
+        await asyncio.sleep(0.01)
+    assert fast.received == ["0", "1", "2", "3", "4"]
+    assert connections[2] not in manager.active_connections and broken.close_code is not None
+    await asyncio.sleep(0.7)
+    assert slow.received == ["0", "3", "4"]
+
+    manager.disconnect(connections[0])
+    manager.broadcast("5")
+    await asyncio.sleep(0.01)
+    assert fast.received[-1] == "4"
+
+    strict = ConnectionManager(queue_size=1, overflow_policy="disconnect", send_timeout=1)
+    slow = FakeWebSocket(delay=0.05)
+    connection = await strict.connect(slow)
+    strict.broadcast("0")
+    await asyncio.sleep(0.01)
+    strict.broadcast("1")
+    strict.broadcast("2")
+    assert connection not in strict.active_connections
+    await connection.writer
+    assert slow.received == ["0"] and slow.close_code == 1008
+    manager.disconnect(connections[1])
+
+@pytest.mark.asyncio
+async def test_redis_broadcast():
+    redis = Redis.from_url(settings.REDIS_URL)
+    nodes = [RedisBroadcast(ConnectionManager(), redis, "test_ws", batch_window=0.01, max_batch=100) for _ in range(2)]
+    sockets = [FakeWebSocket() for _ in nodes]
+    connections = [await node.manager.connect(websocket) for node, websocket in zip(nodes, sockets)]
+    for node in nodes:
+        node.start()
+    while await redis.execute_command("PUBSUB", "NUMSUB", "test_ws") != [b"test_ws", 2]:
+        await asyncio.sleep(0.01)
+
+    for i in range(3):
+        nodes[0].publish(str(i))
+    nodes[1].publish("other")
+    for _ in range(100):
+        if len(sockets[1].received) == 4 and len(sockets[0].received) == 4:
+            break
+        await asyncio.sleep(0.01)
+    # Свои сообщения доставляются локально сразу и не дублируются через Redis
+    assert sockets[0].received == ["0", "1", "2", "other"]
+    assert sockets[1].received == ["other", "0", "1", "2"]
+
+    for node, connection in zip(nodes, connections):
+        node.manager.disconnect(connection)
+        await node.close()
+    await redis.aclose()
+
+@pytest.mark.asyncio
+async def test_write_coalescer(client):
+    async with async_session() as session:
+        user = await get_user_by_username(session, "testuser")
+
+    coalescer = WriteCoalescer(window=0.01, max_batch=3)
+    first, second, missing = await asyncio.gather(
+        coalescer.create_note(user.id, "batched 1"),
+        coalescer.create_note(user.id, "batched 2"),
+        coalescer.update_note(10 ** 9, user.id, "nope"),
+    )
+    assert (first.text, second.text) == ("batched 1", "batched 2")
+    assert first.id != second.id
+    assert missing is None
+
+    updated = await coalescer.update_note(first.id, user.id, "batched 1 updated")
+    assert updated.text == "batched 1 updated"
+    assert await coalescer.update_note(first.id, user.id + 1, "not mine") is None
+
+def test_replica_routing():
+    replica_set = ReplicaSet([settings.DATABASE_URL, settings.DATABASE_URL])
+    assert replica_set.pick() is replica_set.engines[0]
+    assert replica_set.pick() is replica_set.engines[1]
+
+    replica_set.healthy[0] = False
+    assert replica_set.pick() is replica_set.engines[1]
+
+    replica_set.mark_write("testuser")
+    assert replica_set.pick("testuser") is engine
+    assert replica_set.pick("otheruser") is replica_set.engines[1]
+
+def test_redact_parameters():
+    assert redact_parameters(("testuser", 1)) == "['str', 'int']"
+    assert redact_parameters({"password": "secret"}) == "{'password': 'str'}"
+    assert "secret" not in redact_parameters([("secret",), ("secret",)])
@@ -1,17 +1,96 @@
-from fastapi import WebSocket
-from typing import List
+import asyncio
+from contextlib import suppress
+from typing import Optional
+from fastapi import WebSocket, status
+from config import settings
+from logger import logger
+from metrics import WEBSOCKET_CONNECTIONS, WEBSOCKET_MESSAGES_DROPPED
+
+DROP_OLDEST, DROP_NEWEST, DISCONNECT = "drop_oldest", "drop_newest", "disconnect"
+
+# Ставится в очередь вместо сообщения: writer закрывает соединение после уже начатой отправки
+CLOSE = object()
+
+class Connection:
+    """Клиент рассылки: сокет и очередь исходящих сообщений, которую разбирает задача writer."""
+
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: Optional[asyncio.Task] = None
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """
+    Рассылка сообщений подключённым клиентам.
+
+    broadcast только раскладывает сообщение по очередям соединений и не ждёт отправки: у каждого
+    соединения своя задача, которая отправляет сообщения по порядку. Медленный клиент задерживает
+    только себя. Когда его очередь заполнена, срабатывает overflow_policy: drop_oldest вытесняет самое
+    старое сообщение, drop_newest отбрасывает новое, disconnect закрывает соединение. Клиент, который
+    не принял сообщение за send_timeout секунд или отключился, исключается из рассылки.
+    """
 
-    async def connect(self, websocket: WebSocket):
+    def __init__(
+        self,
+        queue_size: int = settings.WS_SEND_QUEUE_SIZE,
+        overflow_policy: str = settings.WS_OVERFLOW_POLICY,
+        send_timeout: float = settings.WS_SEND_TIMEOUT,
+    ):
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.active_connections: set[Connection] = set()
+
+    async def connect(self, websocket: WebSocket) -> Connection:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(websocket, self.queue_size)
+        connection.writer = asyncio.create_task(self._write(connection))
+        self.active_connections.add(connection)
+        WEBSOCKET_CONNECTIONS.set(len(self.active_connections))
+        return connection
+
+    def disconnect(self, connection: Connection):
+        self._remove(connection)
+        if connection.writer is not None:
+            connection.writer.cancel()
+
+    def broadcast(self, message: str):
+        # Копия: при переполнении с политикой disconnect соединение удаляется из множества
+        for connection in list(self.active_connections):
+            try:
+                connection.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self._overflow(connection, message)
+
+    def _remove(self, connection: Connection):
+        self.active_connections.discard(connection)
+        WEBSOCKET_CONNECTIONS.set(len(self.active_connections))
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def _overflow(self, connection: Connection, message: str):
+        WEBSOCKET_MESSAGES_DROPPED.labels(reason=self.overflow_policy).inc()
+        if self.overflow_policy == DROP_OLDEST:
+            connection.queue.get_nowait()
+            connection.queue.put_nowait(message)
+        elif self.overflow_policy == DISCONNECT:
+            logger.warning("WebSocket send queue overflow, closing slow client")
+            self._remove(connection)
+            while not connection.queue.empty():
+                connection.queue.get_nowait()
+            connection.queue.put_nowait(CLOSE)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message) 
\ No newline at end of file
+    async def _write(self, connection: Connection):
+        websocket = connection.websocket
+        try:
+            while True:
+                message = await connection.queue.get()
+                if message is CLOSE:
+                    break
+                await asyncio.wait_for(websocket.send_text(message), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            WEBSOCKET_MESSAGES_DROPPED.labels(reason="send_failed").inc(connection.queue.qsize() + 1)
+            logger.info(f"WebSocket send failed, removing client: {e!r}")
+            self._remove(connection)
+        with suppress(Exception):
+            await asyncio.wait_for(websocket.close(code=status.WS_1008_POLICY_VIOLATION), self.send_timeout)
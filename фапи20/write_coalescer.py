@@ -0,0 +1,132 @@
+import asyncio
+import contextvars
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from sqlalchemy import insert, update, tuple_
+from sqlmodel import select
+from config import settings
+from database import async_session
+from logger import logger
+from metrics import WRITE_BATCH_SIZE, WRITE_BATCH_FLUSH_SECONDS, WRITE_BATCH_FALLBACKS
+from models import Note
+
+@dataclass
+class PendingWrite:
+    kind: str
+    owner_id: int
+    text: str
+    note_id: Optional[int] = None
+    future: Optional[asyncio.Future] = field(default=None, repr=False)
+
+class WriteCoalescer:
+    """
+    Групповая фиксация записей заметок.
+
+    Вызовы create_note/update_note, пришедшие в течение окна (или пока не наберётся
+    max_batch операций), выполняются одной транзакцией: многострочный INSERT ... RETURNING
+    и пакетный UPDATE по первичному ключу. Если пакет падает целиком, операции повторяются
+    по одной, чтобы ошибку получил только запрос, который её вызвал.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: list[PendingWrite] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def create_note(self, owner_id: int, text: str) -> Note:
+        return await self._submit(PendingWrite("create", owner_id, text))
+
+    async def update_note(self, note_id: int, owner_id: int, text: str) -> Optional[Note]:
+        """Возвращает None, если заметки нет или она принадлежит другому пользователю."""
+        return await self._submit(PendingWrite("update", owner_id, text, note_id))
+
+    async def _submit(self, write: PendingWrite):
+        loop = asyncio.get_running_loop()
+        write.future = loop.create_future()
+        self._pending.append(write)
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+        return await write.future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        # Пакет выполняется вне контекста запроса, который его запустил
+        task = asyncio.create_task(self._flush(batch), context=contextvars.Context())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: list[PendingWrite]):
+        WRITE_BATCH_SIZE.observe(len(batch))
+        start = time.perf_counter()
+        try:
+            results = await self._execute(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                WRITE_BATCH_FALLBACKS.inc()
+                logger.warning(f"Write batch of {len(batch)} failed, retrying one by one: {str(e)}")
+                results = []
+                for write in batch:
+                    try:
+                        results.extend(await self._execute([write]))
+                    except Exception as single_error:
+                        results.append(single_error)
+        WRITE_BATCH_FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+        for write, result in zip(batch, results):
+            if write.future.done():
+                continue
+            if isinstance(result, Exception):
+                write.future.set_exception(result)
+            else:
+                write.future.set_result(result)
+
+    async def _execute(self, batch: list[PendingWrite]) -> list[Optional[Note]]:
+        creates = [write for write in batch if write.kind == "create"]
+        updates = [write for write in batch if write.kind == "update"]
+        results: dict[int, Optional[Note]] = {}
+
+        async with async_session() as session:
+            if creates:
+                rows = [Note(owner_id=write.owner_id, text=write.text).model_dump(exclude={"id"}) for write in creates]
+                created = await session.scalars(insert(Note).returning(Note, sort_by_parameter_order=True), rows)
+                for write, note in zip(creates, created.all()):
+                    results[id(write)] = note
+
+            if updates:
+                keys = [(write.note_id, write.owner_id) for write in updates]
+                owned = set((await session.scalars(
+                    select(Note.id).where(tuple_(Note.id, Note.owner_id).in_(keys))
+                )).all())
+                to_update = [write for write in updates if write.note_id in owned]
+                if to_update:
+                    await session.execute(update(Note), [{"id": write.note_id, "text": write.text} for write in to_update])
+                    notes = await session.scalars(select(Note).where(Note.id.in_(owned)))
+                    updated = {note.id: note for note in notes.all()}
+                    for write in to_update:
+                        results[id(write)] = updated.get(write.note_id)
+
+            await session.commit()
+
+        return [results.get(id(write)) for write in batch]
+
+    async def close(self):
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+write_coalescer = WriteCoalescer(
+    window=settings.WRITE_COALESCING_WINDOW_MS / 1000,
+    max_batch=settings.WRITE_COALESCING_MAX_BATCH,
+)